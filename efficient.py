@@ -1,6 +1,10 @@
-from music21 import stream, note, chord, converter, meter
+import numpy
 
+import mprofile
 import mutils
+import notetable
+import pychord
+import scorecache
 
 pickups = [
   'mozart/xml/01-2.xml',
@@ -24,18 +28,76 @@ repeats = [
   ('mozart/xml/05-1.xml', 53)
 ]
 
+"""
+music21 takes about a second to import and is only needed to parse a
+score, so it is imported by load_music21 the first time one is parsed
+rather than with this module.  Scores read from the cache never load it
+"""
+stream = note = chord = converter = meter = None
+
+def load_music21():
+  global stream, note, chord, converter, meter
+  if converter == None:
+    from music21 import stream, note, chord, converter, meter
+
+"""
+The pitch classes in each 12-bit pitch class mask, as a set, and as the
+output string of the key model: the pitch classes in order, joined by
+commas, or 'None' for the empty mask
+"""
+mask_pitch_classes = [set(p for p in range(12) if mask >> p & 1) 
+    for mask in range(1 << 12)]
+mask_strings = [','.join(map(str, sorted(ps))) if ps else 'None' 
+    for ps in mask_pitch_classes]
+
 class EfficientScore:
   
-  def __init__(self, filename):
+  """
+  passing_window is the number of neighbouring notes (in score order) on
+  each side that are searched for the notes a passing tone moves between.
+  None searches all of them.  cache is the directory of the parsed score
+  cache (see scorecache), or None to always parse the score
+  """
+  def __init__(self, filename, passing_window=10, cache=scorecache.cache_dir):
       
     self.filename = filename
+    self.passing_window = passing_window
+    self.s = None
     self.d = dict()
     self.time_sig = None
     self.measure_nums = []
 
+    if not cache == None:
+      with mprofile.stage('load cached score'):
+        digest = scorecache.score_digest(filename, passing_window)
+        cached = scorecache.load(digest, cache)
+      if cached:
+        mprofile.count('score cache hits')
+        self.time_sig, self.measure_nums, self.tables = cached
+        return
+
+    with mprofile.stage('parse'):
+      self._parse()
+
+    with mprofile.stage('note tables'):
+      self.tables = dict()
+      for n in self.d:
+        self.tables[n] = self._note_table(self.d[n])
+
+    if not cache == None:
+      scorecache.save(digest, self.time_sig, self.measure_nums, self.tables,
+          cache)
+
+  """
+  Parses the score with music21 and sorts its measures into self.d
+  """
+  def _parse(self):
+    load_music21()
+    filename = self.filename
     self.s = converter.parse(filename)
 
-    self._mark_passing_tones()
+    with mprofile.stage('passing tones'):
+      self._mark_passing_tones()
 
     if filename.endswith('xml'):
       self._set_dict_from_xml(self.s)
@@ -49,115 +111,196 @@ class EfficientScore:
   def show_measure(self, n):
     if n < 1: 
       return 
+    if self.s == None:
+      self._parse()
     for m in self.d[n]:
       m.flat.show('text')
 
+  """
+  Returns a NoteTable of the notes sounding in [start, stop) of measure n
+  """
   def notes_in_measure(self, n, start, stop):
-    result = []
+    mprofile.count('notes_in_measure')
     if n < 1: 
-      return []
-    for m in self.d[n]:
-      notes_and_chords = m.flat.getElementsByOffset(start, stop,
-            includeEndBoundary=False, mustBeginInSpan=False)
-      for nc in notes_and_chords:
-        if isinstance(nc, note.Note):
-          result.append(nc)
-        elif isinstance(nc, chord.Chord):
+      return notetable.NoteTable()
+    return self.tables[n].window(start, stop)
+
+  """
+  Flattens the given measures into a NoteTable with one row per pitch of
+  every note and chord
+  """
+  def _note_table(self, measures):
+    rows = []
+    for m in measures:
+      for nc in m.flat:
+        if isinstance(nc, note.Note) or isinstance(nc, chord.Chord):
+          ql = nc.duration.quarterLength
+          offset = nc.offset
+          end = float(offset + ql)
+          passing = 1 if nc.isPassing else 0
           for pit in nc.pitches:
-            n = note.Note(pit)
-            n.duration = nc.duration
-            n.isPassing = nc.isPassing
-            n.offset = nc.offset
-            result.append(n)
-    return result   
-
-  def _notes_in_object(self, o):
-    result = []
-    if isinstance(o, note.Note):
-      result.append(o)
-    elif isinstance(o, chord.Chord):
-      for pit in o.pitches:
-        n = note.Note(pit)
-        n.duration = o.duration
-        n.isPassing = c.isPassing
-        n.offset = nc.offset
-        result.append(n)
+            rows.append((pit.midi, pit.pitchClass, float(offset), end,
+              float(ql), passing))
+    return notetable.from_rows(rows)
 
 
   """
   Returns a list of all notes in this score
   """
   def all_notes(self):
+    if self.s == None:
+      self._parse()
     return self.s.flat.notes
   
+  """
+  Returns the observation of every eighth note of the score, measure by
+  measure, as two arrays: the pitch classes sounding, as a mask with bit p
+  set for pitch class p, and the pitch class of the lowest note, or -1
+  where nothing sounds.  Computed in one sweep over the notes of the
+  score; eighth note i of a measure is what notes_in_measure(m, i / 2,
+  (i + 1) / 2) would return
+  """
+  def observations(self):
+    return self._observations(self.measure_nums)
+
+  """
+  Returns the observations of the eighth notes of measure m
+  """
+  def measure_observations(self, m):
+    return self._observations([m])
+
+  def _observations(self, measure_nums):
+    ts = self.time_sig
+    L = mutils.num_eighths_in_measure(ts.numerator, ts.denominator)
+    tables = [self.tables[m] for m in measure_nums if m in self.tables]
+    bases = [L * i for i, m in enumerate(measure_nums) if m in self.tables]
+    masks = numpy.zeros(L * len(measure_nums), dtype=numpy.int32)
+    lows = numpy.full(L * len(measure_nums), 128, dtype=numpy.int32)
+    if sum(len(t) for t in tables) == 0:
+      return masks, lows - 129
+
+    lengths = [len(t) for t in tables]
+    base = numpy.repeat(numpy.array(bases, dtype=numpy.intp), lengths)
+    midi = numpy.concatenate([numpy.frombuffer(t.midi, numpy.int16) 
+      for t in tables])
+    offset = numpy.concatenate([numpy.frombuffer(t.offset) for t in tables])
+    end = numpy.concatenate([numpy.frombuffer(t.end) for t in tables])
+
+    # a note sounds in the eighth notes from the one it starts in through
+    # the one it ends in, since notes that end exactly where a window starts
+    # are counted in it
+    first = numpy.maximum(numpy.floor(2 * offset), 0).astype(numpy.intp)
+    last = numpy.minimum(numpy.floor(2 * end), L - 1).astype(numpy.intp)
+    counts = numpy.maximum(last - first + 1, 0)
+    rows = numpy.repeat(numpy.arange(len(midi)), counts)
+    steps = numpy.arange(len(rows)) - numpy.repeat(numpy.cumsum(counts) - 
+        counts, counts)
+    slots = base[rows] + first[rows] + steps
+    notes = midi[rows].astype(numpy.int32)
+    numpy.bitwise_or.at(masks, slots, 1 << (notes % 12))
+    numpy.minimum.at(lows, slots, notes)
+    return masks, numpy.where(lows < 128, lows % 12, -1)
+
+  """
+  Returns the chord of every eighth note of the score, measure by measure,
+  as two arrays: the index in pychord.Chord.TEMPLATES and the root of the
+  chord made of exactly the pitch classes sounding, or -1 for both where
+  no template fits.  The whole score is looked up at once
+  """
+  def chords(self):
+    masks, basses = self.observations()
+    return pychord.identify_masks(masks)
+
   """
   Returns a list of outputs from this score for use by hmm in the
   Viterbi algorithm
   """
   def output_list(self):
-    ts = self.time_sig
-    L = mutils.num_eighths_in_measure(ts.numerator, ts.denominator)
-    result = []
-    for m in self.measure_nums:
-      for i in range(L):
-        start = float(i) / 2
-        stop = float(i + 1) / 2
-        notes = self.notes_in_measure(m, start, stop)
-        result.append(self._as_observation(notes))
-    return result
+    return self._as_outputs(*self.observations())
+
+  """
+  Returns the outputs for each eighth note of measure m
+  """
+  def outputs_in_measure(self, m):
+    return self._as_outputs(*self.measure_observations(m))
+
+  def _as_outputs(self, masks, basses):
+    return [(mask_pitch_classes[mask], bass) if mask else None 
+        for mask, bass in zip(masks.tolist(), basses.tolist())]
 
   def output_string_list(self):
-    outputs = self.output_list()
-    return map(self._as_string, outputs)
-  
-  def _as_observation(self, notes):
-    s_notes = sorted([(n.pitch.midi, n) for n in notes])
-    if len(notes) == 0:
-      return None
-    bot = s_notes[0][1].pitch.pitchClass
-    ps = set([n.pitch.pitchClass for n in notes])
-    return (ps, bot)
-
-  def _as_string(self, obs):
-    if obs:
-      ps, b = obs
-      return ','.join(map(str, sorted(list(ps))))
-    else:
-      return 'None'
+    masks, basses = self.observations()
+    return [mask_strings[mask] for mask in masks.tolist()]
 
   """
-  Stores a boolean property n.isPassing on each note
+  Yields the output string for each eighth note of the score, measure by
+  measure
+  """
+  def iter_output_strings(self):
+    for mask in self.iter_output_masks():
+      yield mask_strings[mask]
+
+  """
+  Yields the pitch class mask of each eighth note of the score, measure by
+  measure
+  """
+  def iter_output_masks(self):
+    for m in self.measure_nums:
+      masks, basses = self.measure_observations(m)
+      for mask in masks.tolist():
+        yield mask
+  
+  """
+  Stores a boolean property n.isPassing on each note.  A note is passing if
+  every one of its pitches is within a whole step of a pitch of a note
+  ending where it starts and of a note starting where it ends
   """
   def _mark_passing_tones(self):
     ns = self.all_notes()
-    L = len(ns)
-    range = 10
+    window = self.passing_window
+
+    # bucket note indices by onset and by end time, in score order
+    masks = []
+    offsets = []
+    ends = []
+    by_start = dict()
+    by_end = dict()
     for i, n in enumerate(ns):
-      pns = n.pitches
-      leftpns = []
-      for no in ns[max(0, i - range): i]:
-        if no.offset + no.duration.quarterLength == n.offset:
-          leftpns.extend(no.pitches)
-      rightpns = []
-      for no in ns[i + 1: min(i + 1 + range, L)]:
-        if no.offset == n.offset + n.duration.quarterLength:
-          rightpns.extend(no.pitches)
-      if self._is_passing(pns, leftpns) and self._is_passing(pns, rightpns):
-        n.isPassing = True
+      mask = 0
+      for p in n.pitches:
+        mask |= 1 << p.midi
+      start = n.offset
+      end = start + n.duration.quarterLength
+      masks.append(mask)
+      offsets.append(start)
+      ends.append(end)
+      by_start.setdefault(start, []).append(i)
+      by_end.setdefault(end, []).append(i)
+
+    L = len(masks)
+    for i, n in enumerate(ns):
+      if window == None:
+        lo, hi = 0, L
       else:
-        n.isPassing = False
-        
-
-  def _is_passing(self, pns, pms):
-    for p in pns:
-      found = False
-      for q in pms:
-        if abs(p.midi - q.midi) <= 2:
-          found = True
-          break
-      if not found:
-        return False
-    return True
+        lo, hi = max(0, i - window), min(i + 1 + window, L)
+      left = 0
+      for j in by_end.get(offsets[i], ()):
+        if lo <= j < i:
+          left |= masks[j]
+      right = 0
+      for j in by_start.get(ends[i], ()):
+        if i < j < hi:
+          right |= masks[j]
+      n.isPassing = (self._is_passing(masks[i], left) and 
+          self._is_passing(masks[i], right))
+
+  """
+  Takes two sets of MIDI numbers as bit masks and returns True if every
+  pitch in the first is at most two semitones from a pitch in the second
+  """
+  def _is_passing(self, pmask, qmask):
+    near = qmask | (qmask << 1) | (qmask << 2) | (qmask >> 1) | (qmask >> 2)
+    return pmask & ~near == 0
 
   def _set_dict_from_xml(self, s):
     for p in s.parts:
@@ -202,28 +345,3 @@ class EfficientScore:
       if isinstance(o, stream.Voice):
         return True
     return False
-
-  def _reduce_to_list(self, m):
-    result = []
-    notes_and_chords = m.flat
-    for nc in notes_and_chords:
-      result.extend(self._notes_in_object(nc))
-    return result 
-  
-  def _notes_in_object(self, o):
-
-    if isinstance(o, note.Note):
-      return [o] 
-    if isinstance(o, chord.Chord):
-      result = []
-      for pit in o.pitches:
-        n = note.Note(pit)
-        n.duration = o.duration
-        result.append(n)
-      return result
-    if isinstance(o, stream.Voice):
-      result = []
-      for oo in o:
-        result.extend(self._notes_in_object(oo))
-      return result
-    return []
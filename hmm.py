@@ -1,5 +1,8 @@
+from collections import deque
 from math import log
 
+import numpy
+
 """
 Hidden Markov Model class.  Builds itself from a set of training data
 and contains an implementation of the Viterbi algorithm
@@ -8,6 +11,10 @@ class HMM:
 
   dummy_output = '' 
 
+  # Viterbi engine used by most_likely_sequence: 'numpy' runs over dense
+  # log-probability arrays, 'dict' runs over the nested dictionaries
+  backend = 'numpy'
+
   """
   data is a list of lists of pairs of strings (state, obs)  
   """
@@ -60,16 +67,26 @@ class HMM:
       self.log_transition_probs[state] = self._compute_log_probs(
           states_per_state[state])
 
+    self._arrays = None
+
   """
   Uses the Viterbi algorithm to compute the most likely sequence of states
-  corresponding to the given sequence of outputs
+  corresponding to the given sequence of outputs.  backend overrides
+  HMM.backend; both engines return identical sequences
   """
-  def most_likely_sequence(self, outputs):
+  def most_likely_sequence(self, outputs, backend=None):
+    if backend == None:
+      backend = self.backend
     N = len(outputs)
     for i in range(N):
       if not outputs[i] in self.outputs:
         outputs[i] = HMM.dummy_output
 
+    if backend == 'numpy':
+      return self._most_likely_sequence_numpy(outputs)
+    if not backend == 'dict':
+      raise ValueError('unknown Viterbi backend ' + str(backend))
+
     v = [dict() for i in range(N)]
     prev = [dict() for i in range(N)]
     for state in self.states:
@@ -103,7 +120,107 @@ class HMM:
       max_state = prev[i][max_state]
 
     return result
+
+  """
+  Returns the model as dense arrays (states, output_index, starts,
+  transitions, emissions).  states fixes the integer index of each state
+  and follows the iteration order of self.states, so that ties are broken
+  the same way as in the dict engine.  transitions[y, x] is the log
+  probability of moving from y to x and emissions[o, x] the log
+  probability of state x producing output o
+  """
+  def compile(self):
+    if self._arrays:
+      return self._arrays
+    states = list(self.states)
+    outputs = list(self.outputs)
+    output_index = dict((o, i) for i, o in enumerate(outputs))
+
+    starts = numpy.array([self.log_start_probs[x] for x in states])
+    transitions = numpy.array([[self.log_transition_probs[y][x] 
+        for x in states] for y in states])
+    emissions = numpy.array([[self.log_output_probs[x][o] 
+        for x in states] for o in outputs])
+
+    self._arrays = (states, output_index, starts, transitions, emissions)
+    return self._arrays
+
+  """
+  Returns the index in the compiled model (see compile) of each of
+  outputs, as an array; outputs never seen in training get the index of
+  the dummy output
+  """
+  def output_ids(self, outputs):
+    output_index = self.compile()[1]
+    dummy = output_index[HMM.dummy_output]
+    return numpy.array([output_index.get(o, dummy) for o in outputs],
+        dtype=numpy.intp)
+
+  def _most_likely_sequence_numpy(self, outputs):
+    return self.most_likely_sequence_ids(self.output_ids(outputs))
+
+  """
+  most_likely_sequence for outputs given by their indices in the compiled
+  model, as returned by output_ids
+  """
+  def most_likely_sequence_ids(self, obs):
+    N = len(obs)
+    if N == 0:
+      return []
+    states, output_index, starts, transitions, emissions = self.compile()
+    S = len(states)
+    columns = numpy.arange(S)
+
+    prev = numpy.empty((N, S), dtype=numpy.intp)
+    prev[0] = -1
+    v = starts + emissions[obs[0]]
+    for i in range(1, N):
+      # p[y, x] = v[y] + log P(y -> x) + log P(x emits obs[i])
+      p = v[:, None] + transitions + emissions[obs[i]]
+      best = p.argmax(axis=0)
+      prev[i] = best
+      v = p[best, columns]
+
+    max_state = int(v.argmax())
+    result = [None for i in range(N)]
+    for i in range(N - 1, -1, -1):
+      result[i] = states[max_state]
+      max_state = prev[i, max_state]
+
+    return result
     
+  """
+  Viterbi decoding of a stream of outputs: yields the state for each
+  output as soon as an OnlineDecoder with the given lag commits to it
+  """
+  def fixed_lag_sequence(self, outputs, lag):
+    output_index = self.compile()[1]
+    dummy = output_index[HMM.dummy_output]
+    return self.fixed_lag_sequence_ids((output_index.get(o, dummy) 
+      for o in outputs), lag)
+
+  """
+  fixed_lag_sequence for outputs given by their indices in the compiled
+  model
+  """
+  def fixed_lag_sequence_ids(self, obs, lag):
+    decoder = OnlineDecoder(self, lag)
+    for o in obs:
+      decoder.push_id(o)
+      for state in decoder.emit():
+        yield state
+    for state in decoder.finish():
+      yield state
+
+  """
+  Returns the finished model as a tuple of plain containers (states,
+  outputs, start, output and transition log probabilities) that can be
+  saved and handed back to from_tables
+  """
+  def tables(self):
+    return (self.states, self.outputs, self.log_start_probs,
+        self.log_output_probs, self.log_transition_probs)
+
   def _compute_log_probs(self, d):
     total = sum(d[k] for k in d)
     result = dict()
@@ -111,6 +228,124 @@ class HMM:
       result[k] = log(float(d[k]) / total)
     return result
 
+"""
+Incremental Viterbi decoder.  Outputs are pushed one at a time and the
+states of a prefix of them are committed, to be collected with emit:
+
+- when the best paths into every current state agree on a state, that
+  state and all earlier ones are on the final Viterbi path, and are
+  committed
+- when lag is not None and more than lag outputs are still undecided,
+  the oldest is committed by tracing back from the currently best state
+
+Backpointers are kept only for the undecided outputs.  With lag None (or
+at least the number of outputs) the committed states are exactly those of
+most_likely_sequence; smaller lags bound memory and delay at the cost of
+sometimes committing before the evidence is in
+"""
+class OnlineDecoder:
+
+  def __init__(self, model, lag=None):
+    (self.states, self.output_index, self.starts, self.transitions,
+        self.emissions) = model.compile()
+    self.dummy = self.output_index[HMM.dummy_output]
+    self.columns = numpy.arange(len(self.states))
+    self.lag = lag
+
+    self.v = None
+    # backs[i] links the (i + 1)th undecided output to the ith
+    self.backs = deque()
+    self.pending = 0
+    self.committed = []
+
+  def push(self, output):
+    self.push_id(self.output_index.get(output, self.dummy))
+
+  """
+  Pushes the output with the given index in the compiled model
+  """
+  def push_id(self, o):
+    e = self.emissions[o]
+    if self.v is None:
+      self.v = self.starts + e
+    else:
+      p = self.v[:, None] + self.transitions + e
+      best = p.argmax(axis=0)
+      self.v = p[best, self.columns]
+      if self.pending > 0:
+        self.backs.append(best)
+    self.pending += 1
+
+    self._commit_agreed()
+    if not self.lag == None:
+      while self.pending > self.lag:
+        x = int(self.v.argmax())
+        for b in reversed(self.backs):
+          x = b[x]
+        self._commit([x])
+
+  """
+  Returns the states committed since the last call, in order
+  """
+  def emit(self):
+    result = self.committed
+    self.committed = []
+    return result
+
+  """
+  Commits every remaining state by tracing back from the best final state
+  and returns all states not yet emitted
+  """
+  def finish(self):
+    if self.pending > 0:
+      x = int(self.v.argmax())
+      path = [x]
+      for b in reversed(self.backs):
+        x = b[x]
+        path.append(x)
+      path.reverse()
+      self._commit(path)
+    return self.emit()
+
+  """
+  Follows the best path into every current state backwards, and commits
+  everything up to the most recent output where all of them agree
+  """
+  def _commit_agreed(self):
+    ancestors = self.columns
+    for i in range(len(self.backs) - 1, -1, -1):
+      ancestors = self.backs[i][ancestors]
+      if ancestors.min() == ancestors.max():
+        x = ancestors[0]
+        path = [x]
+        for b in reversed(list(self.backs)[:i]):
+          x = b[x]
+          path.append(x)
+        path.reverse()
+        self._commit(path)
+        return
+
+  """
+  Commits the states with the given indices for the oldest undecided
+  outputs, and forgets the backpointers leading to them
+  """
+  def _commit(self, path):
+    for x in path:
+      self.committed.append(self.states[x])
+      self.pending -= 1
+      if len(self.backs) > 0:
+        self.backs.popleft()
+
+"""
+Builds an HMM directly from the tables returned by HMM.tables without
+counting any training data
+"""
+def from_tables(tables):
+  model = HMM([])
+  (model.states, model.outputs, model.log_start_probs, 
+      model.log_output_probs, model.log_transition_probs) = tables
+  return model
+
 def main():
   data = []
   data.append([])
@@ -0,0 +1,77 @@
+import numpy
+
+"""
+A labeling of a piece as a grid of measures by eighth notes.  Each cell
+holds the id of the label sounding there, an index into values, which are
+the tuples (rn, key, major, score) of as_labeling; empty cells hold -1.
+
+Iterating over a grid or indexing it gives the rows of as_labeling, pairs
+(measure number, list of values or None per eighth note), so code written
+for lists of measures works unchanged
+"""
+class LabelGrid(object):
+
+  def __init__(self, measures, ids, values):
+    self.measures = measures
+    self.ids = ids
+    self.values = values
+
+  @property
+  def measure_len(self):
+    return self.ids.shape[1]
+
+  def __len__(self):
+    return len(self.measures)
+
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      return [self.row(j) for j in range(len(self))[i]]
+    return self.row(i)
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self.row(i)
+
+  def row(self, i):
+    values = self.values
+    return (self.measures[i],
+        [values[v] if v >= 0 else None for v in self.ids[i].tolist()])
+
+  def __repr__(self):
+    return 'LabelGrid({0} measures x {1} eighths, {2} labels)'.format(
+        len(self), self.measure_len, len(self.values))
+
+"""
+Builds the grid of a list of labels in one pass.  Rows are the measures
+that have labels, in order; a label overwrites the labels before it where
+they overlap, and every empty cell takes the label before it in its
+measure, except at the start of a measure, which stays empty
+"""
+def from_labels(labels):
+  measure_len = max([lab.stop_int for lab in labels]) if len(labels) > 0 else 0
+  measures = sorted(set([lab.measure for lab in labels]))
+  rows = dict((m, i) for i, m in enumerate(measures))
+  ids = numpy.full((len(measures), measure_len), -1, dtype=numpy.int32)
+  values = []
+  interned = {}
+  for lab in labels:
+    value = (lab.rn, lab.key, lab.major, lab.score)
+    v = interned.get(value)
+    if v == None:
+      v = len(values)
+      interned[value] = v
+      values.append(value)
+    ids[rows[lab.measure], lab.start_int:lab.stop_int] = v
+  return LabelGrid(measures, forward_fill(ids), values)
+
+"""
+Fills every cell holding -1 with the nearest non-empty cell to its left in
+the same row; cells with nothing to their left stay -1
+"""
+def forward_fill(ids):
+  if ids.size == 0:
+    return ids
+  cols = numpy.arange(ids.shape[1])
+  last = numpy.where(ids >= 0, cols, 0)
+  numpy.maximum.accumulate(last, axis=1, out=last)
+  return numpy.take_along_axis(ids, last, axis=1)
@@ -0,0 +1,355 @@
+import copy
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# first, for the startup report (see mprofile)
+import mprofile
+
+import efficient
+import menumerate
+import mkeys
+import mlabel
+import mmarkov
+import msegment
+import mutils
+import notetable
+import pychord
+import refinements
+import scorecache
+
+"""
+Benchmarks of every stage of the analysis in mlabel.  Runs on synthetic
+scores, so no corpus is needed: random pieces in each of the time
+signatures in meters, and the small scores in benchmarks/ when music21 is
+installed.  For each stage it reports the best time of a number of runs,
+the throughput in measures per second and the peak memory allocated while
+it runs.  Results can be saved as a JSON baseline and compared with a
+later run:
+
+$ python mbench.py --save=before.json
+$ python mbench.py --compare=before.json
+"""
+
+fixtures_dir = 'benchmarks/'
+meters = [(3, 4), (4, 4), (6, 8), (2, 2)]
+
+# a stage this much slower than in the baseline is reported as a regression
+regression_ratio = 1.2
+
+"""
+A note of a synthetic score.  Has the attributes of a music21 note that
+_mark_passing_tones reads and writes
+"""
+class SyntheticNote(object):
+
+  __slots__ = ('pitches', 'offset', 'duration', 'isPassing', 'measure',
+      'measure_offset')
+
+  def __init__(self, midis, offset, quarter_length, measure, measure_offset):
+    self.pitches = [SyntheticPitch(p) for p in midis]
+    self.offset = offset
+    self.duration = SyntheticDuration(quarter_length)
+    self.isPassing = False
+    self.measure = measure
+    self.measure_offset = measure_offset
+
+class SyntheticPitch(object):
+
+  __slots__ = ('midi', 'pitchClass')
+
+  def __init__(self, midi):
+    self.midi = midi
+    self.pitchClass = midi % 12
+
+class SyntheticDuration(object):
+
+  __slots__ = ('quarterLength',)
+
+  def __init__(self, quarter_length):
+    self.quarterLength = quarter_length
+
+"""
+Stands in for a parsed music21 score: s.flat.notes is the list of notes
+"""
+class SyntheticScore(object):
+
+  def __init__(self, notes):
+    self.notes = notes
+    self.flat = self
+
+scale = [0, 2, 4, 5, 7, 9, 11]
+progressions = [[0, 3, 4, 0], [0, 5, 1, 4], [0, 3, 6, 2], [5, 1, 4, 0]]
+
+"""
+Returns the notes of a random piece of the given number of measures: a
+bass note and a melody over a diatonic chord progression, with the melody
+moving by step through passing tones, and a modulation every eight
+measures
+"""
+def random_notes(rng, numerator, denominator, measures):
+  measure_len = float(numerator) * 4 / denominator
+  # a chord lasts a dotted quarter in compound meters and a quarter or half
+  # note otherwise
+  if denominator == 8:
+    chord_len = 1.5
+  elif measure_len % 2 == 0:
+    chord_len = rng.choice([1.0, 2.0])
+  else:
+    chord_len = 1.0
+  tonic = rng.randint(0, 11)
+  progression = rng.choice(progressions)
+  notes = []
+  step = 0
+  for m in range(1, measures + 1):
+    if m % 8 == 0:
+      tonic = (tonic + rng.choice([7, 5, 9])) % 12
+    pos = 0.0
+    while pos < measure_len:
+      length = min(chord_len, measure_len - pos)
+      degree = progression[step % len(progression)]
+      step += 1
+      triad = [tonic + scale[(degree + i) % 7] for i in (0, 2, 4)]
+      start = (m - 1) * measure_len + pos
+      notes.append(SyntheticNote([36 + triad[0] % 12], start, length, m, pos))
+      notes.append(SyntheticNote([48 + t % 12 for t in triad[1:]], start,
+        length, m, pos))
+      # the melody walks from one chord tone to the next in eighth notes
+      top = 60 + triad[rng.randint(0, 2)] % 12
+      t = 0.0
+      while t < length:
+        notes.append(SyntheticNote([top], start + t, 0.5, m, pos + t))
+        top += rng.choice([-2, -1, 1, 2])
+        t += 0.5
+      pos += length
+  return notes
+
+"""
+Builds an EfficientScore of a random piece without music21.  Its passing
+tones are left unmarked until _mark_passing_tones is run on it
+"""
+def random_score(seed, numerator, denominator, measures):
+  rng = random.Random(seed)
+  es = efficient.EfficientScore.__new__(efficient.EfficientScore)
+  es.filename = 'random-{0}-{1}-{2}.krn'.format(numerator, denominator, seed)
+  es.passing_window = 10
+  es.s = SyntheticScore(random_notes(rng, numerator, denominator, measures))
+  es.d = dict()
+  es.time_sig = scorecache.TimeSignature(numerator, denominator)
+  es.measure_nums = list(range(1, measures + 1))
+  es.tables = synthetic_tables(es.s.notes)
+  return es
+
+def synthetic_tables(notes):
+  rows = dict()
+  for n in notes:
+    end = n.measure_offset + n.duration.quarterLength
+    for p in n.pitches:
+      rows.setdefault(n.measure, []).append((p.midi, p.pitchClass,
+        n.measure_offset, end, n.duration.quarterLength,
+        1 if n.isPassing else 0))
+  return dict((m, notetable.from_rows(r)) for m, r in rows.items())
+
+"""
+Runs f once under tracemalloc and then repeat times more, returning (best
+time in seconds, peak memory in bytes, result of the last run)
+"""
+def measure(f, repeat):
+  tracemalloc.start()
+  tracemalloc.reset_peak()
+  result = f()
+  peak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  best = None
+  for i in range(repeat):
+    t = time.perf_counter()
+    result = f()
+    t = time.perf_counter() - t
+    if best == None or t < best:
+      best = t
+  return best, peak, result
+
+"""
+Times each stage of the analysis of es, in the order mlabel runs them.
+Returns a list of (stage, seconds, peak bytes)
+"""
+def bench_score(es, models, repeat, cache_dir=None):
+  key_model, model, sectionaries = models
+  results = []
+
+  def stage(name, f):
+    seconds, peak, result = measure(f, repeat)
+    results.append((name, seconds, peak))
+    return result
+
+  if not cache_dir == None:
+    load_cached(es, cache_dir)
+    stage('load (cache)', lambda: load_cached(es, cache_dir))
+  if not es.s == None:
+    stage('passing tones', es._mark_passing_tones)
+  if isinstance(es.s, SyntheticScore):
+    es.tables = synthetic_tables(es.s.notes)
+
+  masks, basses = stage('observations', es.observations)
+  stage('chords', lambda: pychord.identify_masks(masks))
+  keylist = stage('key viterbi', lambda: list(map(mkeys.extract_pair,
+    key_model.most_likely_sequence_ids(mlabel.key_output_ids(key_model)[
+      masks]))))
+
+  ts = es.time_sig
+  to_check = menumerate.sections_to_check(ts.numerator, ts.denominator)
+  mark_len = int(round(2 * max([b for a, b in to_check])))
+  measures = stage('templates', lambda: [mlabel.measure_candidates(es,
+    sectionaries, keylist, m, i * mark_len, to_check)
+    for i, m in enumerate(es.measure_nums)])
+
+  def greedy():
+    labels = []
+    prev_label = None
+    for results in measures:
+      new_labels = mlabel.label_measure(es, results, model, mark_len,
+          prev_label)
+      prev_label = new_labels[-1]
+      labels.extend(new_labels)
+    return labels
+  labels = stage('label_measure', greedy)
+  stage('msegment', lambda: msegment.label_measures(measures, model,
+    mark_len, mlabel.get_section_size_bound(mark_len), mlabel.markov_factor))
+
+  # every rule sees the labels as the rules before it left them.  The rules
+  # change labels in place, so each run gets its own copy, made beforehand
+  for rule in refinements.RULES:
+    copies = [[copy.copy(lab) for lab in labels] for i in range(repeat + 1)]
+    labels = stage('refine ' + rule.name, lambda: list(
+      refinements.apply_rules([rule], copies.pop(),
+        refinements.Context(es, mark_len))))
+  stage('as_labeling', lambda: mutils.as_dmitri_output(
+    mutils.as_labeling(labels)))
+  return results
+
+def load_cached(es, cache_dir):
+  filename = os.path.join(cache_dir, es.filename)
+  if not os.path.exists(filename):
+    f = open(filename, 'w')
+    f.write(es.filename)
+    f.close()
+    scorecache.save(scorecache.score_digest(filename, es.passing_window),
+        es.time_sig, es.measure_nums, es.tables, cache_dir)
+  return efficient.EfficientScore(filename, es.passing_window, cache_dir)
+
+"""
+Times parsing the scores in benchmarks/ with music21 and the stages after
+it.  Returns a dict from the name of each score to its results, which is
+empty if music21 is not installed
+"""
+def bench_fixtures(models, repeat, path=fixtures_dir):
+  try:
+    efficient.load_music21()
+  except ImportError:
+    return dict()
+  results = dict()
+  for name in sorted(os.listdir(path)):
+    if not (name.endswith('.krn') or name.endswith('.xml')):
+      continue
+    filename = os.path.join(path, name)
+    seconds, peak, es = measure(lambda: efficient.EfficientScore(filename,
+      cache=None), repeat)
+    results[name] = ([('load (parse)', seconds, peak)] +
+      bench_score(es, models, repeat), len(es.measure_nums))
+  return results
+
+def run(measures=64, seed=0, repeat=3):
+  models = (mkeys.hmm_from_training_dir(),
+      mmarkov.load(),
+      mutils.load_sectionaries())
+  benchmarks = dict()
+  cache_dir = tempfile.mkdtemp(prefix='mbench')
+  try:
+    for n, d in meters:
+      es = random_score(seed, n, d, measures)
+      benchmarks['random {0}/{1}'.format(n, d)] = (bench_score(es, models,
+        repeat, cache_dir), measures)
+  finally:
+    shutil.rmtree(cache_dir)
+  benchmarks.update(bench_fixtures(models, repeat))
+
+  result = {
+    'python': platform.python_version(),
+    'machine': platform.machine(),
+    'measures': measures,
+    'seed': seed,
+    'repeat': repeat,
+    'benchmarks': dict()
+  }
+  for name, (stages, num_measures) in benchmarks.items():
+    result['benchmarks'][name] = [{
+      'stage': stage,
+      'seconds': seconds,
+      'measures_per_sec': num_measures / seconds if seconds > 0 else None,
+      'peak_bytes': peak
+    } for stage, seconds, peak in stages]
+  return result
+
+def report(result, baseline=None, out=sys.stdout):
+  regressions = []
+  for name in sorted(result['benchmarks']):
+    out.write('\n{0}\n'.format(name))
+    out.write('{0:<28}{1:>10}{2:>14}{3:>12}'.format('stage', 'ms',
+      'measures/s', 'peak KiB'))
+    old = dict()
+    if baseline and name in baseline['benchmarks']:
+      old = dict((s['stage'], s) for s in baseline['benchmarks'][name])
+      out.write('{0:>10}'.format('vs base'))
+    out.write('\n')
+    for s in result['benchmarks'][name]:
+      rate = s['measures_per_sec']
+      out.write('{0:<28}{1:>10.2f}{2:>14}{3:>12.1f}'.format(s['stage'],
+        1000 * s['seconds'], '-' if rate == None else '{0:.0f}'.format(rate),
+        s['peak_bytes'] / 1024.0))
+      if s['stage'] in old and old[s['stage']]['seconds'] > 0:
+        ratio = s['seconds'] / old[s['stage']]['seconds']
+        out.write('{0:>9.2f}x'.format(ratio))
+        if ratio > regression_ratio:
+          regressions.append((name, s['stage'], ratio))
+          out.write(' slower')
+      out.write('\n')
+  return regressions
+
+def main():
+  args = mprofile.take_option(sys.argv[1:])
+  options = dict()
+  for arg in args:
+    if arg.startswith('--') and '=' in arg:
+      key, value = arg[2:].split('=', 1)
+      options[key] = value
+    else:
+      raise ValueError('unknown option ' + arg)
+
+  result = run(int(options.get('measures', 64)), int(options.get('seed', 0)),
+      int(options.get('repeat', 3)))
+  mprofile.mark('benchmarks')
+
+  baseline = None
+  if 'compare' in options:
+    f = open(options['compare'])
+    baseline = json.load(f)
+    f.close()
+  regressions = report(result, baseline)
+
+  if 'save' in options:
+    f = open(options['save'], 'w')
+    json.dump(result, f, indent=2, sort_keys=True)
+    f.close()
+
+  if len(regressions) > 0:
+    print('\n{0} stages slower than the baseline'.format(len(regressions)))
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,211 @@
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+# first, for the startup report (see mprofile)
+import mprofile
+
+import numpy
+
+import mreader
+import mutils
+import pychord
+
+"""
+Evaluation of computed analyses against reference analyses.  Both are
+laid out on a grid of eighth notes, and every eighth note the reference
+labels is scored three ways: whether the key (tonic and mode) matches,
+whether the roman numeral matches, and whether it matches ignoring its
+inversion (just_numeral_with_secondary).  Eighth notes the computed
+analysis leaves unlabeled count as wrong
+"""
+
+"""
+Counts of the eighth notes scored and of those right in each way.  Adds up
+over movements
+"""
+class Accuracy(object):
+
+  __slots__ = ('eighths', 'key', 'numeral', 'reduced')
+
+  def __init__(self, eighths=0, key=0, numeral=0, reduced=0):
+    self.eighths = eighths
+    self.key = key
+    self.numeral = numeral
+    self.reduced = reduced
+
+  def __add__(self, other):
+    return Accuracy(self.eighths + other.eighths, self.key + other.key,
+        self.numeral + other.numeral, self.reduced + other.reduced)
+
+  """
+  Returns the fractions (key, numeral, numeral ignoring inversion) right
+  """
+  def rates(self):
+    if self.eighths == 0:
+      return (0.0, 0.0, 0.0)
+    n = float(self.eighths)
+    return (self.key / n, self.numeral / n, self.reduced / n)
+
+  def __repr__(self):
+    return 'Accuracy({0}, key={1:.3f}, numeral={2:.3f}, reduced={3:.3f})'\
+        .format(self.eighths, *self.rates())
+
+"""
+Returns arrays (key, major, numeral id) with one entry per eighth note of
+measures 0 to num_measures - 1 of an mreader.Analysis, measure_len eighth
+notes each; -1 where nothing is labeled.  A later label overwrites an
+earlier one where they overlap
+"""
+def as_grid(analysis, num_measures, measure_len):
+  size = num_measures * measure_len
+  key = numpy.full(size, -1, dtype=numpy.int32)
+  major = numpy.full(size, -1, dtype=numpy.int32)
+  numeral = numpy.full(size, -1, dtype=numpy.int32)
+  if len(analysis) == 0:
+    return key, major, numeral
+
+  measure = numpy.frombuffer(analysis.measure, dtype=numpy.int32)
+  first = numpy.rint(2 * numpy.frombuffer(analysis.start)).astype(numpy.intp)
+  last = numpy.rint(2 * numpy.frombuffer(analysis.stop)).astype(numpy.intp)
+  first = numpy.clip(first, 0, measure_len)
+  last = numpy.clip(last, 0, measure_len)
+  counts = numpy.maximum(last - first, 0)
+  counts[(measure < 0) | (measure >= num_measures)] = 0
+  rows = numpy.repeat(numpy.arange(len(measure)), counts)
+  steps = numpy.arange(len(rows)) - numpy.repeat(numpy.cumsum(counts) -
+      counts, counts)
+  slots = measure[rows] * measure_len + first[rows] + steps
+  # slots are in row order, so the last row to cover a slot sets it
+  key[slots] = numpy.frombuffer(analysis.key, dtype=numpy.int8)[rows]
+  major[slots] = numpy.frombuffer(analysis.major, dtype=numpy.int8)[rows]
+  numeral[slots] = numpy.frombuffer(analysis.numeral, dtype=numpy.int32)[rows]
+  return key, major, numeral
+
+"""
+Returns an array giving for each numeral id in mreader.numerals the id of
+its numeral ignoring inversion, interning those as needed
+"""
+def reduced_numeral_ids():
+  reduced = []
+  # reducing a numeral may intern a new one, which is reduced in turn
+  i = 0
+  while i < len(mreader.numerals):
+    reduced.append(mreader.intern(
+      pychord.just_numeral_with_secondary(mreader.numerals[i])))
+    i += 1
+  return numpy.array(reduced, dtype=numpy.int32)
+
+"""
+Scores the computed mreader.Analysis against the reference one
+"""
+def evaluate(computed, reference):
+  if len(reference) == 0:
+    return Accuracy()
+  num_measures = 1 + max(max(reference.measure),
+      max(computed.measure) if len(computed) > 0 else 0)
+  measure_len = int(round(2 * max(max(reference.stop),
+      max(computed.stop) if len(computed) > 0 else 0)))
+  ckey, cmajor, cnumeral = as_grid(computed, num_measures, measure_len)
+  rkey, rmajor, rnumeral = as_grid(reference, num_measures, measure_len)
+
+  scored = rnumeral >= 0
+  labeled = scored & (cnumeral >= 0)
+  reduced = reduced_numeral_ids()
+  key = labeled & (ckey == rkey) & (cmajor == rmajor)
+  numeral = labeled & (cnumeral == rnumeral)
+  same = labeled & (reduced[numpy.maximum(cnumeral, 0)] ==
+      reduced[numpy.maximum(rnumeral, 0)])
+  return Accuracy(int(scored.sum()), int(key.sum()), int(numeral.sum()),
+      int(same.sum()))
+
+"""
+Returns the rows of a list of label.Label as an mreader.Analysis, so that
+labels computed in memory can be evaluated
+"""
+def from_labels(labels):
+  result = mreader.Analysis()
+  for lab in labels:
+    result.measure.append(lab.measure)
+    result.start.append(lab.start)
+    result.stop.append(lab.stop)
+    result.key.append(-1 if lab.key == None else lab.key)
+    result.major.append(-1 if lab.major == None else int(lab.major))
+    result.numeral.append(mreader.intern(pychord.numeral_reformatted(lab.rn)))
+  return result
+
+"""
+Scores the saved analysis of the movement called name (as written by
+mlabel) against its reference analysis.  Returns None if either is missing
+"""
+def evaluate_movement(name):
+  computed = mreader.read_file(mutils.dmitri_output(name))
+  reference = mreader.read_file(mutils.analysis(name))
+  if computed == None or reference == None:
+    return None
+  return evaluate(computed, reference)
+
+"""
+Scores every movement in names with a pool of jobs worker processes (one
+per cpu if jobs is None).  Returns a list of pairs (name, Accuracy or None)
+in the order of names
+"""
+def evaluate_all(names, jobs=None):
+  if jobs == 1:
+    return [(name, evaluate_movement(name)) for name in names]
+  with ProcessPoolExecutor(max_workers=jobs) as executor:
+    return list(zip(names, executor.map(evaluate_movement, names,
+      chunksize=4)))
+
+"""
+Writes a table of the accuracy of each movement, followed by the total
+over every eighth note (all) and the mean over movements (mean)
+"""
+def report(results, out=sys.stdout):
+  out.write('{0:<16}{1:>8}{2:>8}{3:>10}{4:>10}\n'.format('movement',
+    'eighths', 'key', 'numeral', 'reduced'))
+  total = Accuracy()
+  rates = []
+  for name, acc in results:
+    if acc == None:
+      out.write('{0:<16}{1:>8}\n'.format(mutils.no_ext(name), 'missing'))
+      continue
+    total = total + acc
+    rates.append(acc.rates())
+    out.write('{0:<16}{1:>8}{2:>8.3f}{3:>10.3f}{4:>10.3f}\n'.format(
+      mutils.no_ext(name), acc.eighths, *acc.rates()))
+  out.write('{0:<16}{1:>8}{2:>8.3f}{3:>10.3f}{4:>10.3f}\n'.format('all',
+    total.eighths, *total.rates()))
+  if len(rates) > 0:
+    mean = numpy.mean(numpy.array(rates), axis=0)
+    out.write('{0:<16}{1:>8}{2:>8.3f}{3:>10.3f}{4:>10.3f}\n'.format('mean',
+      len(rates), *mean))
+  return total
+
+"""
+Returns the names of every movement with a reference analysis
+"""
+def movement_names():
+  path = os.path.dirname(mutils.analysis('x'))
+  return [os.path.splitext(x)[0] for x in sorted(os.listdir(path))]
+
+"""
+Scores the movements given on the command line, or every movement with a
+reference analysis if none are given
+"""
+def main():
+  args = mprofile.take_option(sys.argv[1:])
+  jobs = None
+  names = []
+  for arg in args:
+    if arg.startswith('--jobs='):
+      jobs = int(arg[len('--jobs='):])
+    else:
+      names.append(arg)
+  if len(names) == 0:
+    names = movement_names()
+  report(evaluate_all(names, jobs))
+  mprofile.mark('evaluate')
+
+if __name__ == '__main__':
+  main()
@@ -1,6 +1,21 @@
+import hashlib
 import os
+import sys
+
+# first, for the startup report (see mprofile)
+import mprofile
 
 import hmm
+import picklefile
+
+training_dir = 'keytrainingdata/'
+
+"""
+Compiled key model.  Holds the finished log-probability tables together
+with a hash of the training data they were counted from
+"""
+cache_file = 'keymodel.pickle'
+cache_version = 2
 
 def hmm_from_filenames(filenames):
   data = []
@@ -16,17 +31,71 @@ def hmm_from_filenames(filenames):
   data = [run for run in data if len(run) > 0]
   return hmm.HMM(data)
 
-def hmm_from_training_dir():
-  path = 'keytrainingdata/'
-  filenames = map(lambda x: path + x, os.listdir(path))
-  return hmm_from_filenames(filenames)
+"""
+Returns the key model trained on every file in path.  The compiled model
+in cache is used when it was built from the same training data, and is
+rebuilt otherwise
+"""
+def hmm_from_training_dir(path=training_dir, cache=cache_file):
+  digest = training_digest(path)
+  model = load_compiled(cache, digest)
+  if not model:
+    model = compile_training_dir(path, cache, digest)
+  return model
+
+"""
+Trains the key model on every file in path and writes its tables to cache
+"""
+def compile_training_dir(path=training_dir, cache=cache_file, digest=None):
+  if not digest:
+    digest = training_digest(path)
+  filenames = [os.path.join(path, x) for x in sorted(os.listdir(path))]
+  model = hmm_from_filenames(filenames)
+  save_compiled(model, cache, digest)
+  return model
+
+"""
+Returns a hash of the names and contents of the training files in path
+"""
+def training_digest(path=training_dir):
+  h = hashlib.sha1()
+  for name in sorted(os.listdir(path)):
+    h.update(name.encode('utf-8') + b'\0')
+    f = open(os.path.join(path, name), 'rb')
+    h.update(f.read())
+    f.close()
+  return h.hexdigest()
+
+def save_compiled(model, cache, digest):
+  try:
+    picklefile.save(cache, cache_version, (digest, model.tables()))
+  except (IOError, OSError):
+    pass
+
+"""
+Returns the model stored in cache, or None if it is missing, was written
+by another cache version or was built from different training data
+"""
+def load_compiled(cache, digest):
+  contents = picklefile.load(cache, cache_version)
+  if contents == None or not contents[0] == digest:
+    return None
+  return hmm.from_tables(contents[1])
 
 def extract_pair(state):
   pair = state.split('-')
   return int(pair[0]), (pair[1] == 'True')
 
 def main():
+  args = mprofile.take_option(sys.argv[1:])
+  if len(args) > 0 and args[0] == 'compile':
+    model = compile_training_dir()
+    mprofile.mark('compile')
+    print('Wrote {0} ({1} states, {2} outputs)'.format(cache_file,
+      len(model.states), len(model.outputs)))
+    return
   model = hmm_from_training_dir()
+  mprofile.mark('key model')
   print(model.log_start_probs)
 
 if __name__ == '__main__':
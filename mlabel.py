@@ -1,14 +1,20 @@
+import itertools
 import sys
 import os
+from concurrent.futures import ProcessPoolExecutor
+
+# first, for the startup report (see mprofile)
+import mprofile
 
 import efficient
 import label
 import menumerate
 import mkeys
 import mmarkov
+import msegment
 import mutils
 import refinements
-import section
+import windowstore
 
 def get_section_size_bound(n):
   if n == 3:
@@ -17,24 +23,26 @@ def get_section_size_bound(n):
     return n
 
 def min_with_tiebreak(pairs):
-  s, section = min(pairs)
+  s, section = min(pairs, key=lambda p: p[0])
   choices = [(len(sec.rn), sec) for sc, sec in pairs if sc - s < 0.000001]
-  length, result = min(choices)
+  length, result = min(choices, key=lambda c: c[0])
   return (s, result)
 
-def label_measure(es, labels, model, mark_len, prev_lab):
+# weight associated with markov model
+markov_factor = 0.8
+
+def label_measure(es, labels, model, mark_len, prev_lab, factor=None):
+  if factor == None:
+    factor = markov_factor
   chosen_labels = []
   
-  # weight associated with markov model
-  markov_factor = 0.8
-  
   x = []
   for lab in labels:
 
     if lab.start == 0 and lab.stop_int < get_section_size_bound(mark_len):
       if prev_lab:
         if prev_lab.key == lab.key:
-          x.append((lab.score + markov_factor * (
+          x.append((lab.score + factor * (
             1 - model.score(prev_lab.rn, lab.rn)), lab))
         else:
           x.append((lab.score, lab))
@@ -44,17 +52,19 @@ def label_measure(es, labels, model, mark_len, prev_lab):
   chosen_labels.append(cur)
   pos = cur.stop_int
 
+  ids = model.symbol_ids([lab.rn for lab in labels])
+  cur_id = model.symbol_id(cur.rn)
   while pos < mark_len:
-    choices = []
-    for lab in labels:
-      if lab.start_int in [pos]:
-        choices.append((lab.score + markov_factor * (
-            1 - model.score(cur.rn, lab.rn)), lab))
+    here = [i for i, lab in enumerate(labels) if lab.start_int == pos]
+    scores = model.score_many(cur_id, ids[here])
+    choices = [(labels[i].score + factor * (1 - float(sc)), labels[i])
+        for i, sc in zip(here, scores)]
     dist, choice  = min_with_tiebreak(choices)
     if dist < 100:
       chosen_labels.append(choice)
       pos = choice.stop_int
       cur = choice
+      cur_id = model.symbol_id(cur.rn)
     else:
       pos += 1
 
@@ -82,87 +92,251 @@ def add(section, measure):
       dirty = True
   return result, dirty
 
+"""
+Returns the candidate labels for measure m, the best 3 templates for each
+window in to_check, sorted by score.  base_index is the index in keylist
+of the first eighth note of the measure.  The windows are taken from
+store, a windowstore.WindowStore of es and sectionaries, if one is given
+"""
+def measure_candidates(es, sectionaries, keylist, m, base_index, to_check,
+    store=None):
+  if store == None:
+    store = windowstore.WindowStore(es, sectionaries)
+  results = []
+  for start, stop in to_check:
+    index = base_index + int(round(start * 2))
+    k, maj = keylist[index]
+    w = store.window(m, start, stop, k, maj)
+    mprofile.count('template windows')
+    results.extend([label.Label(s, m, start, stop, k, maj, rn) 
+      for s, rn in w.nearest(3)])
+  results.sort(key=lambda x: x.score)
+  return results
+
 """
 labels the given sonata represented as a measure dictionary, returning
 a list of lists of pairs (rn, k), one for each 8th note in each
-measure
+measure.  segmenter chooses how each measure is divided among its
+candidate labels: 'greedy' (label_measure) or 'dp' (msegment)
 """
-def label_piece(es, sectionaries, keylist, model, single=None):
-  labels = []
+def label_piece(es, sectionaries, keylist, model, single=None, 
+    segmenter='greedy'):
   ts = es.time_sig
   to_check = menumerate.sections_to_check(ts.numerator, ts.denominator)
   mark_len = int(round(2 * max([b for a, b in to_check])))
-  prev_label = None
+  store = windowstore.WindowStore(es, sectionaries)
+
+  if not single == None:
+    es.show_measure(single)
+    base_index = (single - 1) * mark_len
+    results = measure_candidates(es, sectionaries, keylist, single, 
+        base_index, to_check, store)
+    print(keylist[base_index + int(round(2 * to_check[-1][0]))])
+    for r in results:
+      print(r)
+    return 
+
+  measures = []
+  for i, m in enumerate(es.measure_nums):
+    with mprofile.stage('templates'):
+      measures.append(measure_candidates(es, sectionaries, keylist, m, 
+        i * mark_len, to_check, store))
+  with mprofile.stage('segmentation'):
+    labels = segment(es, measures, model, mark_len, segmenter)
+
+  with mprofile.stage('refinements'):
+    labels = refinements.refine(labels, es, store)
+
+  return labels
+
+"""
+Chooses labels for the whole piece from measures, a list with the
+candidate labels of each measure as returned by measure_candidates, with
+the given segmenter and weight of the markov model (markov_factor if None)
+"""
+def segment(es, measures, model, mark_len, segmenter='greedy', factor=None):
+  if factor == None:
+    factor = markov_factor
+  if segmenter == 'dp':
+    return msegment.label_measures(measures, model, mark_len,
+        get_section_size_bound(mark_len), factor)
+  elif segmenter == 'greedy':
+    labels = []
+    prev_label = None
+    for results in measures:
+      new_labels = label_measure(es, results, model, mark_len, prev_label,
+          factor)
+      prev_label = new_labels[-1]
+      labels.extend(new_labels)
+    return labels
+  raise ValueError('unknown segmenter ' + str(segmenter))
 
-  base_index = 0
+"""
+Runs the whole analysis of one movement and returns its list of labels
+"""
+def analyze(name, key_model, model, sectionaries, segmenter='greedy'):
+  mprofile.begin(name)
+  try:
+    es = efficient.EfficientScore(mutils.sonata(name))
+    mprofile.mark('load ' + name)
+    return label_piece(es, sectionaries, score_keys(es, key_model), model,
+        segmenter=segmenter)
+  finally:
+    mprofile.end()
+
+"""
+Returns the most likely (key, major) pair for each eighth note of the score
+"""
+def score_keys(es, key_model):
+  with mprofile.stage('observations'):
+    masks, basses = es.observations()
+  with mprofile.stage('key decoding'):
+    outputs = key_output_ids(key_model)[masks]
+    return list(map(mkeys.extract_pair, 
+      key_model.most_likely_sequence_ids(outputs)))
 
+"""
+Returns an array giving the index in key_model of the output for each
+pitch class mask
+"""
+def key_output_ids(key_model):
+  return key_model.output_ids(efficient.mask_strings)
+
+# windows kept by the streaming analysis, enough for the few measures the
+# refinements look back over
+stream_windows = 1024
+
+# most eighth notes the streaming key decoder may leave undecided; None
+# waits until the key is certain, which matches label_piece exactly
+key_lag = 64
+
+"""
+Analyzes a score as a pipeline of generators and yields the lines of its
+analysis in as_dmitri_output format, each as soon as it is final.  Keys
+are decoded online by hmm.OnlineDecoder with the given lag, measures are
+labeled greedily one at a time and the refinements look at most a few
+labels ahead, so the keys, labels and windows in flight are bounded.  The
+score itself is still loaded whole by EfficientScore beforehand, so
+memory grows with the size of the score
+"""
+def analyze_stream(es, key_model, model, sectionaries, lag=key_lag):
+  ts = es.time_sig
+  to_check = menumerate.sections_to_check(ts.numerator, ts.denominator)
+  mark_len = int(round(2 * max([b for a, b in to_check])))
+
+  output_ids = key_output_ids(key_model)
+  keys = map(mkeys.extract_pair, key_model.fixed_lag_sequence_ids(
+    (output_ids[mask] for mask in es.iter_output_masks()), lag))
+  store = windowstore.WindowStore(es, sectionaries, stream_windows)
+  labels = stream_labels(es, sectionaries, model, keys, to_check, mark_len,
+      store)
+  labels = refinements.stream_refine(labels, es, mark_len, store=store)
+  return mutils.iter_dmitri_output(mutils.iter_labeling(labels, mark_len))
+
+"""
+Yields the labels chosen by label_measure for each measure in turn, taking
+the (key, major) pair of each eighth note from the iterator keys
+"""
+def stream_labels(es, sectionaries, model, keys, to_check, mark_len,
+    store=None):
+  prev_label = None
   for m in es.measure_nums:
-    if not single == None:
-      m = single
-      es.show_measure(m)
-    results = []
-    for start, stop in to_check:
-      if not single == None:
-        index = (m - 1) * mark_len + int(round(start * 2))
-      else:
-        index = base_index + int(round(start * 2))
-      k, maj = keylist[index]
-      if maj:
-        sectionary = sectionaries[0]
-      else:
-        sectionary = sectionaries[1]
-      notes = es.notes_in_measure(m, start, stop)
-      nsec = section.from_notes(notes, k)
-      pairs = [(sec.distance(nsec), sec.numeral) for sec in sectionary]
-      choices = [label.Label(
-        s, m, start, stop, k, maj, rn) for s, rn in pairs]
-      results.extend(sorted(choices, key=lambda x: x.score)[:3])
-    results.sort(key=lambda x: x.score)
-    new_labels= label_measure(es, results, model, mark_len, prev_label)
+    keylist = list(itertools.islice(keys, mark_len))
+    with mprofile.stage('templates'):
+      results = measure_candidates(es, sectionaries, keylist, m, 0, to_check,
+          store)
+    with mprofile.stage('segmentation'):
+      new_labels = label_measure(es, results, model, mark_len, prev_label)
     prev_label = new_labels[-1]
-    labels.extend(new_labels)
-    base_index += mark_len
-    if not single == None:
-      print((k, maj))
-      for r in results:
-        print(r)
-      return 
- 
-  labels = refinements.fill_gaps(labels)
-  labels = refinements.fix_prefixes(labels)
-  labels = refinements.fix_triples(labels, es)
-  labels = refinements.join_adjacents(labels)
-  labels = refinements.fix_inversions(labels, es)
-  labels = refinements.rename_errors(labels)
-  labels = refinements.fix_common_errors(labels, es)
-  labels = refinements.fix_Vs(labels, es)
-  labels = refinements.fix_basses(labels, es)
+    for lab in new_labels:
+      yield lab
 
-  return labels
+# models shared by every movement analyzed in a batch worker process
+_worker_models = None
+
+def _init_worker(key_model, model, sectionaries, segmenter):
+  global _worker_models
+  _worker_models = (key_model, model, sectionaries, segmenter)
+
+def _analyze_in_worker(name):
+  key_model, model, sectionaries, segmenter = _worker_models
+  return mutils.as_labeling(analyze(name, key_model, model, sectionaries,
+    segmenter))
+
+"""
+Analyzes every movement in names with a pool of jobs worker processes
+(one per cpu if jobs is None), loading the models only once.  Yields
+pairs (name, labeling) in the order of names
+"""
+def analyze_batch(names, key_model, model, sectionaries, jobs=None,
+    segmenter='greedy'):
+  if jobs == 1:
+    _init_worker(key_model, model, sectionaries, segmenter)
+    for name in names:
+      yield name, _analyze_in_worker(name)
+    return
+  with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+      initargs=(key_model, model, sectionaries, segmenter)) as executor:
+    for name, labeling in zip(names, executor.map(_analyze_in_worker, names)):
+      yield name, labeling
 
 def main():
+  args = mprofile.take_option(sys.argv[1:])
+  single = None
+  jobs = None
+  segmenter = 'greedy'
+  stream = False
+  names = args
+  while len(names) > 0 and names[0][0] == '-':
+    opt = names.pop(0)
+    if opt.startswith('--jobs='):
+      jobs = int(opt[len('--jobs='):])
+    elif opt == '--dp':
+      segmenter = 'dp'
+    elif opt == '--stream':
+      stream = True
+    else:
+      single = int(opt[1:])
+  if stream and segmenter == 'dp':
+    sys.stderr.write('mlabel.py: --stream labels measures greedily and '
+        'cannot be used with --dp\n')
+    sys.exit(2)
+
   key_model = mkeys.hmm_from_training_dir()
-  model = mmarkov.from_file('transitionmodels/model.txt')
+  mprofile.mark('key model')
+  model = mmarkov.load()
+  mprofile.mark('markov model')
   sectionaries = mutils.load_sectionaries()
+  mprofile.mark('templates')
   
-  single = None
-  names = sys.argv[1:]
-  if sys.argv[1][0] == '-':
-    single = int(sys.argv[1][1:])
-    names = names[1:] 
-  
+  if len(names) > 1 and single == None and not stream:
+    for name, labeling in analyze_batch(names, key_model, model, 
+        sectionaries, jobs, segmenter):
+      mutils.save_dmitri_output(name, labeling)
+      print(mutils.dmitri_output(name))
+      mprofile.mark('analyze ' + name)
+    return
+
   for name in names:
-      es = efficient.EfficientScore(mutils.sonata(name))
-      outputs = es.output_string_list()
-      keylist = map(mkeys.extract_pair, key_model.most_likely_sequence(outputs))
-     
-      if not single == None:
+      if stream:
+        mprofile.begin(name)
+        try:
+          es = efficient.EfficientScore(mutils.sonata(name))
+          mprofile.mark('load ' + name)
+          for line in analyze_stream(es, key_model, model, sectionaries):
+            print(line)
+            sys.stdout.flush()
+        finally:
+          mprofile.end()
+      elif not single == None:
+        es = efficient.EfficientScore(mutils.sonata(name))
+        keylist = score_keys(es, key_model)
         label_piece(es, sectionaries, keylist, model, single=single)
       else:
-        sections = label_piece(es, sectionaries, keylist, model)
-        if len(names) < 2:
-          for line in mutils.as_dmitri_output(mutils.as_labeling(sections)):
-            print(line)
+        sections = analyze(name, key_model, model, sectionaries, segmenter)
+        for line in mutils.as_dmitri_output(mutils.as_labeling(sections)):
+          print(line)
+      mprofile.mark('analyze ' + name)
 
 if __name__ == '__main__':
   main()
@@ -1,17 +1,85 @@
+import hashlib
+import os
 import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+# first, for the startup report (see mprofile)
+import mprofile
+
+import numpy
 
 import mutils
 import mreader
+import picklefile
 import pychord
 
 """
-Markov Model data type compatible with Mozart analyses
+Markov Model data type compatible with Mozart analyses.  The table of
+transition probabilities is compiled into a dense matrix over integer
+symbol ids: matrix[i, j] is score(symbols[i], symbols[j])
 """
 class MarkovModel:
   
   def __init__(self, table, use_inversions):
     self.table = table
     self.use_inversions = use_inversions
+    self._compile()
+
+  def _compile(self):
+    self.symbols = []
+    self.ids = dict()
+    for s in self.table:
+      self._intern(s)
+      for t in self.table[s]:
+        self._intern(t)
+    for s in self.symbols[:]:
+      self._intern(pychord.just_numeral_with_secondary(s))
+    
+    V = len(self.symbols)
+    self.matrix = numpy.zeros((V, V))
+    for s in self.table:
+      i = self.ids[s]
+      for t in self.table[s]:
+        self.matrix[i, self.ids[t]] = self.table[s][t]
+    numpy.fill_diagonal(self.matrix, 1)
+
+    # the same matrix seen with inversions dropped: reduced_ids[i] is the
+    # id of just_numeral_with_secondary(symbols[i])
+    self.reduced_ids = numpy.array([self.ids[
+      pychord.just_numeral_with_secondary(s)] for s in self.symbols],
+      dtype=int)
+
+  """
+  Returns the id of symbol s, adding it (with no outgoing transitions) if
+  it is new
+  """
+  def _intern(self, s):
+    if s in self.ids:
+      return self.ids[s]
+    i = len(self.symbols)
+    self.symbols.append(s)
+    self.ids[s] = i
+    if hasattr(self, 'reduced_ids'):
+      self.matrix = numpy.pad(self.matrix, ((0, 1), (0, 1)))
+      self.matrix[i, i] = 1
+      self.reduced_ids = numpy.append(self.reduced_ids, i)
+      self.reduced_ids[i] = self._intern(
+        pychord.just_numeral_with_secondary(s))
+    return i
+
+  """
+  Returns the id used to score symbol s, which ignores its inversion if
+  this model does
+  """
+  def symbol_id(self, s):
+    i = self._intern(s)
+    if not self.use_inversions:
+      return int(self.reduced_ids[i])
+    return i
+
+  def symbol_ids(self, xs):
+    return numpy.array([self.symbol_id(s) for s in xs], dtype=int)
 
   def print_table_pretty(self):
     for s in self.table:
@@ -21,34 +89,44 @@ class MarkovModel:
       print('')
 
   def print_table(self):
-    out = ''
+    print(self.table_string())
+
+  def table_string(self):
+    lines = []
     for s in self.table:
-      out = out + s
+      fields = [s]
       for t in self.table[s]:
-        out = out + ' ' + t + ' ' + str(self.table[s][t])
-      out = out + '\n'
-    print(out)
+        fields.append(t + ' ' + str(self.table[s][t]))
+      lines.append(' '.join(fields) + '\n')
+    return ''.join(lines)
 
 
   """
-  Returns probability of symbol t following symbol s
+  Returns probability of symbol t following symbol s.  A symbol that is
+  never followed by another in the analyses the model was made from is
+  taken to be followed only by itself
   """
   def score(self, s, t):
-    if not self.use_inversions:
-      s = pychord.just_numeral_with_secondary(s)
-      t = pychord.just_numeral_with_secondary(t)
-    if s == t:
+    i = self.symbol_id(s)
+    j = self.symbol_id(t)
+    if i == j:
       return 1
-    if not t in self.table[s]:
-      return 0
-    return self.table[s][t]
+    return float(self.matrix[i, j])
+
+  """
+  Returns an array of the probabilities of each of the symbols with ids
+  candidate_ids following the symbol with id prev_id
+  """
+  def score_many(self, prev_id, candidate_ids):
+    candidate_ids = numpy.asarray(candidate_ids, dtype=int)
+    return self.matrix[prev_id, candidate_ids]
 
   """
   Returns minimum of all transition probabilities in the list
   """
   def listscore(self, xs):
     if not self.use_inversions:
-      xs = map(pychord.just_numeral_with_secondary, xs)
+      xs = list(map(pychord.just_numeral_with_secondary, xs))
     if len(xs) < 2:
       return 1
     scores = [self.score(s, t) for s, t in zip(xs, xs[1:]) if not s == t]
@@ -57,37 +135,186 @@ class MarkovModel:
     result =  sum(scores) / len(scores)
     return result
 
-def from_analyses(filenames, use_inversions=True):
-  ttable = dict()
+"""
+Counting transitions.  Each analysis file is read into a Counter of the
+pairs (rn1, rn2) of consecutive numerals in the same key; counters of
+different files add up, so the files can be counted in parallel and a
+corpus can be recounted file by file.  The binary model file keeps the
+counter of every file with its modification time, size and a hash of its
+contents and is reused as a cache: training again only hashes the files
+whose time or size changed, and only counts those whose hash changed
+"""
+model_dir = 'transitionmodels/'
+text_file = model_dir + 'model.txt'
+binary_file = model_dir + 'model.pickle'
+binary_version = 3
+
+"""
+Returns a Counter of the transitions in the analysis in filename
+"""
+def count_transitions(filename, use_inversions=True):
+  counts = Counter()
+  analysis = mreader.read_file(filename)
+  if analysis:
+    rns = [mreader.numerals[i] for i in analysis.numeral]
+    if not use_inversions:
+      rns = list(map(pychord.just_numeral_with_secondary, rns))
+    keys = analysis.key
+    for i in range(len(rns) - 1):
+      if keys[i] == keys[i + 1]:
+        counts[(rns[i], rns[i + 1])] += 1
+  return counts
+
+def file_digest(filename):
+  h = hashlib.sha1()
+  f = open(filename, 'rb')
+  h.update(f.read())
+  f.close()
+  return h.hexdigest()
+
+"""
+Returns (modification time, size) of filename, which change whenever its
+contents do
+"""
+def file_stamp(filename):
+  st = os.stat(filename)
+  return (st.st_mtime_ns, st.st_size)
+
+"""
+Returns a dict from each of filenames to a triple (stamp, digest, Counter
+of its transitions).  Counts in known, a dict of the same form, are reused
+without opening the file when its stamp has not changed, and after
+hashing it when only its stamp has; the other files are counted by a pool
+of jobs worker processes (one per cpu if jobs is None).  Files in trusted
+are taken from known as they are, without looking at them at all.  Raises
+OSError if a file that has to be looked at does not exist
+"""
+def count_files(filenames, use_inversions=True, known=None, jobs=None,
+    trusted=()):
+  if known == None:
+    known = dict()
+  result = dict()
+  todo = []
+  for filename in filenames:
+    if filename in trusted:
+      result[filename] = known[filename]
+      continue
+    stamp = file_stamp(filename)
+    old = known.get(filename)
+    if not old == None and old[0] == stamp:
+      result[filename] = old
+      continue
+    digest = file_digest(filename)
+    if not old == None and old[1] == digest:
+      result[filename] = (stamp, digest, old[2])
+    else:
+      result[filename] = (stamp, digest, None)
+      todo.append(filename)
+
+  if jobs == 1 or len(todo) < 2:
+    counted = [count_transitions(x, use_inversions) for x in todo]
+  else:
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+      counted = list(executor.map(count_transitions, todo,
+        [use_inversions] * len(todo)))
+  for filename, counts in zip(todo, counted):
+    stamp, digest = result[filename][:2]
+    result[filename] = (stamp, digest, counts)
+  return result
+
+"""
+Adds up the counters of the files, in the order of filenames
+"""
+def merge_counts(files, filenames):
+  total = Counter()
   for filename in filenames:
-    analysis = mreader.from_file(filename)
-    if analysis:
-      for a, b in zip(analysis, analysis[1:]): 
-        k1 = a.key
-        rn1 = a.rn
-        k2 = b.key
-        rn2 = b.rn
-
-        if not use_inversions:
-          rn1 = pychord.just_numeral_with_secondary(rn1)
-          rn2 = pychord.just_numeral_with_secondary(rn2)
-        if k1 == k2:
-          if not rn1 in ttable:
-            ttable[rn1] = []
-          ttable[rn1].append(rn2)
+    total.update(files[filename][2])
+  return total
+
+"""
+Builds the model whose probability of rn2 following rn1 is the fraction
+of the transitions out of rn1 in counts that go to rn2
+"""
+def from_counts(counts, use_inversions=True):
+  totals = Counter()
+  for (s, t), n in counts.items():
+    totals[s] += n
   table = dict()
-  for s in ttable:
-    temp = dict()
-    for t in ttable[s]:
-      if not t in temp:
-        temp[t] = 0
-      temp[t] += 1
-    total = sum([temp[t] for t in temp])
-    table[s] = dict()
-    for t in ttable[s]:
-      table[s][t] = float(temp[t]) / total
+  for (s, t), n in counts.items():
+    if not s in table:
+      table[s] = dict()
+    table[s][t] = float(n) / totals[s]
   return MarkovModel(table, use_inversions)
 
+def from_analyses(filenames, use_inversions=True, jobs=None):
+  files = count_files(filenames, use_inversions, jobs=jobs)
+  return from_counts(merge_counts(files, filenames), use_inversions)
+
+"""
+Trains the model on filenames and writes it to text and binary.  The
+counts stored in binary are reused for files that have not changed, and
+with add the files already in binary and not in filenames are kept as
+they were stored, without being opened, so one new analysis can be added
+without reading the others
+"""
+def train(filenames, use_inversions=True, jobs=None, add=False,
+    text=text_file, binary=binary_file):
+  known = load_counts(binary, use_inversions)
+  trusted = ()
+  if add:
+    trusted = set(known) - set(filenames)
+    filenames = [x for x in known if x in trusted] + list(filenames)
+  files = count_files(filenames, use_inversions, known, jobs, trusted)
+  model = from_counts(merge_counts(files, filenames), use_inversions)
+  save_text(model, text)
+  save_binary(model, files, binary)
+  return model
+
+def save_text(model, filename=text_file):
+  f = open(filename, 'w')
+  f.write(model.table_string())
+  f.close()
+
+"""
+Writes the model's table together with the counts of every file it was
+trained on
+"""
+def save_binary(model, files, filename=binary_file):
+  picklefile.save(filename, binary_version,
+      (model.use_inversions, model.table, files))
+
+"""
+Loads a model written by save_binary
+"""
+def from_binary(filename=binary_file, use_inversions=True):
+  contents = picklefile.load(filename, binary_version)
+  if contents == None:
+    return None
+  inversions, table, files = contents
+  return MarkovModel(table, use_inversions)
+
+"""
+Returns the counts of every file stored in binary, or an empty dict if
+there are none for the given use_inversions
+"""
+def load_counts(filename=binary_file, use_inversions=True):
+  contents = picklefile.load(filename, binary_version)
+  if contents == None or not contents[0] == use_inversions:
+    return dict()
+  return contents[2]
+
+"""
+Loads the trained model, from the binary file when it is at least as new
+as the text file
+"""
+def load(text=text_file, binary=binary_file, use_inversions=True):
+  if (os.path.exists(binary) and 
+      os.path.getmtime(binary) >= os.path.getmtime(text)):
+    model = from_binary(binary, use_inversions)
+    if model:
+      return model
+  return from_file(text, use_inversions)
+
 """
 Loads a markov model stored in a file
 """
@@ -104,9 +331,38 @@ def from_file(filename, use_inversions=True):
         d[s][fields[i]] = float(fields[i + 1])
   return MarkovModel(d, use_inversions)
 
+"""
+With --save, trains the model on the given analyses and writes it to
+transitionmodels/ (--add keeps the analyses it was trained on before);
+otherwise prints the table of the model trained on them
+"""
 def main():
-  model = from_analyses(sys.argv[1:], use_inversions=True)
+  args = mprofile.take_option(sys.argv[1:])
+  jobs = None
+  save = False
+  add = False
+  while len(args) > 0 and args[0].startswith('--'):
+    opt = args.pop(0)
+    if opt.startswith('--jobs='):
+      jobs = int(opt[len('--jobs='):])
+    elif opt == '--save':
+      save = True
+    elif opt == '--add':
+      save = True
+      add = True
+    else:
+      raise ValueError('unknown option ' + opt)
+
+  if save:
+    model = train(args, use_inversions=True, jobs=jobs, add=add)
+    mprofile.mark('train')
+    print('Wrote {0} and {1} ({2} symbols)'.format(text_file, binary_file,
+      len(model.table)))
+    return
+  model = from_analyses(args, use_inversions=True, jobs=jobs)
+  mprofile.mark('count transitions')
   model.print_table()
+  mprofile.mark('print table')
 
 if __name__ == '__main__':
   main()
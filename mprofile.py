@@ -0,0 +1,223 @@
+import atexit
+import json
+import os
+import sys
+import time
+
+"""
+Startup timing.  The entry points (mlabel, mkeys, mmarkov, mevaluate,
+mbench, msweep) import this module right after the standard library and
+before numpy or any other of the project's modules, so that started is
+close to the start of the process and the startup report counts the time
+taken to import the rest.  With --timing they record a mark after each
+step of startup and the time taken by each is written to stderr when the
+program exits
+"""
+started = time.perf_counter()
+timing = False
+marks = []
+
+"""
+Profiling of the stages of an analysis, turned on by setting the
+environment variable MLABEL_PROFILE or passing --profile.  Between begin
+and end (one movement) every stage records its wall time, number of calls
+and its net blocks, and counters record how often things such as
+notes_in_measure happen.  Net blocks is the change in the number of
+memory blocks the interpreter holds (sys.getallocatedblocks) from the
+start of the stage to its end: what the stage left allocated, negative if
+it freed more than it allocated.  It is cheap enough to take on every
+call, but says nothing of memory allocated and freed within the stage;
+mbench measures peak memory with tracemalloc.  end writes a summary table
+to stderr and a Chrome trace (chrome://tracing, or ui.perfetto.dev) of
+the movement to profile_dir.  When profiling is off stage and count do
+nothing
+"""
+profiling = bool(os.environ.get('MLABEL_PROFILE'))
+profile_dir = 'profiles/'
+current = None
+
+"""
+Removes --timing and --profile from the list of command line arguments
+args, turning on the startup report or profiling if they were there
+"""
+def take_option(args):
+  global timing, profiling
+  if '--timing' in args:
+    args.remove('--timing')
+    if not timing:
+      timing = True
+      mark('imports')
+      atexit.register(report)
+  if '--profile' in args:
+    args.remove('--profile')
+    profiling = True
+    # so that worker processes profile their movements too
+    os.environ['MLABEL_PROFILE'] = '1'
+  return args
+
+"""
+Records that the step called name has just finished
+"""
+def mark(name):
+  if timing:
+    marks.append((name, time.perf_counter()))
+
+def report(out=None):
+  if out == None:
+    out = sys.stderr
+  last = started
+  out.write('{0:<24}{1:>10}{2:>10}\n'.format('step', 'ms', 'total'))
+  for name, t in marks:
+    out.write('{0:<24}{1:>10.1f}{2:>10.1f}\n'.format(name,
+      1000 * (t - last), 1000 * (t - started)))
+    last = t
+  loaded = 'music21' in sys.modules
+  out.write('music21 loaded: {0}\n'.format('yes' if loaded else 'no'))
+
+"""
+What was recorded while analyzing one movement.  stages maps each stage
+name to [seconds, calls, net blocks], in the order the stages first ran
+"""
+class Profile(object):
+
+  def __init__(self, name):
+    self.name = name
+    self.started = time.perf_counter()
+    self.stages = dict()
+    self.counters = dict()
+    self.events = []
+
+  def add(self, name, start, seconds, blocks, trace):
+    if not name in self.stages:
+      self.stages[name] = [0.0, 0, 0]
+    totals = self.stages[name]
+    totals[0] += seconds
+    totals[1] += 1
+    totals[2] += blocks
+    if trace:
+      self.events.append((name, start, seconds, blocks))
+
+  def summary(self, out):
+    total = time.perf_counter() - self.started
+    out.write('profile of {0}: {1:.1f} ms\n'.format(self.name, 1000 * total))
+    out.write('{0:<28}{1:>10}{2:>8}{3:>10}{4:>12}\n'.format('stage', 'ms',
+      '%', 'calls', 'net blocks'))
+    for name, (seconds, calls, blocks) in self.stages.items():
+      out.write('{0:<28}{1:>10.1f}{2:>8.1f}{3:>10}{4:>12}\n'.format(name,
+        1000 * seconds, 100 * seconds / total if total > 0 else 0, calls,
+        blocks))
+    for name in sorted(self.counters):
+      out.write('{0:<28}{1:>46}\n'.format(name, self.counters[name]))
+
+  """
+  Returns the profile as a Chrome trace-event object: a complete event per
+  traced stage call, and the counters as of the end of the movement
+  """
+  def trace(self):
+    pid = os.getpid()
+    events = []
+    for name, start, seconds, blocks in self.events:
+      events.append({'name': name, 'ph': 'X', 'pid': pid, 'tid': 0,
+        'ts': 1e6 * (start - self.started), 'dur': 1e6 * seconds,
+        'args': {'net blocks': blocks}})
+    end = 1e6 * (time.perf_counter() - self.started)
+    for name, (seconds, calls, blocks) in self.stages.items():
+      events.append({'name': name, 'ph': 'C', 'pid': pid, 'ts': end,
+        'args': {'ms': 1000 * seconds, 'calls': calls,
+          'net blocks': blocks}})
+    if len(self.counters) > 0:
+      events.append({'name': 'counters', 'ph': 'C', 'pid': pid, 'ts': end,
+        'args': dict(self.counters)})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms',
+        'otherData': {'movement': self.name}}
+
+class _Stage(object):
+
+  __slots__ = ('profile', 'name', 'trace', 'start', 'blocks')
+
+  def __init__(self, profile, name, trace):
+    self.profile = profile
+    self.name = name
+    self.trace = trace
+
+  def __enter__(self):
+    self.blocks = sys.getallocatedblocks()
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc):
+    seconds = time.perf_counter() - self.start
+    self.profile.add(self.name, self.start, seconds,
+        sys.getallocatedblocks() - self.blocks, self.trace)
+    return False
+
+class _NoStage(object):
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    return False
+
+_no_stage = _NoStage()
+
+"""
+Starts profiling the movement called name, if profiling is on
+"""
+def begin(name):
+  global current
+  if profiling:
+    current = Profile(name)
+
+"""
+Finishes the movement begun last, writing its summary to stderr and its
+trace to profile_dir
+"""
+def end():
+  global current
+  profile = current
+  current = None
+  if profile == None:
+    return
+  profile.summary(sys.stderr)
+  try:
+    if not os.path.isdir(profile_dir):
+      os.makedirs(profile_dir)
+    filename = os.path.join(profile_dir,
+        os.path.basename(profile.name) + '.trace.json')
+    f = open(filename, 'w')
+    json.dump(profile.trace(), f)
+    f.close()
+    sys.stderr.write('trace written to {0}\n'.format(filename))
+  except (IOError, OSError) as e:
+    sys.stderr.write('could not write trace: {0}\n'.format(e))
+
+"""
+Returns a context manager that records the time spent in it as the stage
+called name.  Stages with trace False are only totalled, which suits
+stages entered very many times
+"""
+def stage(name, trace=True):
+  if current == None:
+    return _no_stage
+  return _Stage(current, name, trace)
+
+"""
+Adds n to the counter called name
+"""
+def count(name, n=1):
+  if not current == None:
+    current.counters[name] = current.counters.get(name, 0) + n
+
+"""
+Returns f, or while profiling a function that calls f as the untraced
+stage called name
+"""
+def timed(name, f):
+  profile = current
+  if profile == None:
+    return f
+  def timed_f(*args):
+    with _Stage(profile, name, False):
+      return f(*args)
+  return timed_f
@@ -1,29 +1,153 @@
-import sys
 import os
+import re
+import sys
+from array import array
 
 import pynote
 import pychord
 import label
 
 """
-generates an analysis from a file, as a list of tuples
-(measure, start, stop, key, numeral)
+An analysis read from a file, column by column: row i is a label in
+measure[i] from start[i] to stop[i] (in quarter notes from the start of
+the measure) in the key with pitch class key[i], major if major[i] is 1
+(-1 for both before the first key), with the roman numeral
+numerals[numeral[i]]
+"""
+class Analysis(object):
+
+  __slots__ = ('measure', 'start', 'stop', 'key', 'major', 'numeral')
+
+  def __init__(self):
+    self.measure = array('i')
+    self.start = array('d')
+    self.stop = array('d')
+    self.key = array('b')
+    self.major = array('b')
+    self.numeral = array('i')
+
+  def __len__(self):
+    return len(self.measure)
+
+  def rn(self, i):
+    return numerals[self.numeral[i]]
+
+  def key_at(self, i):
+    if self.key[i] < 0:
+      return None
+    return self.key[i]
+
+  def major_at(self, i):
+    if self.major[i] < 0:
+      return None
+    return self.major[i] == 1
+
+  """
+  Returns the rows as a list of label.Label
+  """
+  def labels(self):
+    return [label.Label(0, self.measure[i], self.start[i], self.stop[i],
+      self.key_at(i), self.major_at(i), self.rn(i)) for i in range(len(self))]
+
+"""
+The numerals of every analysis read, by id.  A token that is a roman
+numeral is stored as the id of its numeral_reformatted form
+"""
+numerals = []
+numeral_ids = dict()
+
+time_signature = re.compile(r'ime signature', re.IGNORECASE)
+
+# what each distinct token means, worked out the first time it is seen
+_numeral_tokens = dict()
+_key_tokens = dict()
+_beat_tokens = dict()
+
+"""
+Returns the id of the numeral token s, or -1 if s is not a roman numeral
+"""
+def _numeral_id(s):
+  i = _numeral_tokens.get(s)
+  if i == None:
+    i = -1
+    if pychord.is_valid_numeral(s):
+      i = intern(pychord.numeral_reformatted(s))
+    _numeral_tokens[s] = i
+  return i
+
+"""
+Returns the id of the numeral rn in numerals, adding it if it is new
+"""
+def intern(rn):
+  i = numeral_ids.get(rn)
+  if i == None:
+    i = len(numerals)
+    numeral_ids[rn] = i
+    numerals.append(rn)
+  return i
+
+def _key(s):
+  result = _key_tokens.get(s)
+  if result == None:
+    key = s[:s.index(':')]
+    result = (pynote.from_string(key).pitch_class, key.isupper())
+    _key_tokens[s] = result
+  return result
+
+def _beat(s):
+  if not s in _beat_tokens:
+    _beat_tokens[s] = float(s[1:]) if _is_beat_label(s) else None
+  return _beat_tokens[s]
+
+"""
+generates an analysis from a file, as a list of label.Label
 """
 def from_file(filename):
+  analysis = read_file(filename)
+  if analysis == None:
+    return None
+  return analysis.labels()
+
+"""
+Reads the analysis in filename into an Analysis, or returns None if there
+is no such file
+"""
+def read_file(filename):
   if not os.path.exists(filename):
     return None
   f = open(filename, 'r')
-  k = None
-  maj = None
-  result = []
+  text = f.read()
+  f.close()
+  return parse(text)
+
+"""
+Parses the text of an analysis in one pass over its tokens.  A numeral
+starts at the last beat label before it on its line and lasts until the
+next numeral in its measure, or else until the end of the measure, whose
+length is only known at the end of the file
+"""
+def parse(text):
+  result = Analysis()
+  measure = result.measure
+  start = result.start
+  stop = result.stop
+  key = result.key
+  major = result.major
+  numeral = result.numeral
+  # rows that last to the end of their measure
+  to_end = []
+
+  k = -1
+  maj = -1
   numbeats = 4
   top = 4
   bot = 4
-  offset = 0
-  for line in f.readlines():
+  for line in text.splitlines():
+    if len(line) == 0:
+      continue
 
     # Determine number of beats per measure
-    if 'ime signature' in line.lower():
+    if time_signature.search(line):
       top = int(line[line.index('/') - 1])
       bot = int(line[line.index('/') + 1])
       if bot == 4:
@@ -46,36 +170,47 @@ def from_file(filename):
     else:
       continue
     
-    for i, s in enumerate(toks):
+    beat = 1
+    for s in toks:
       if s.find(':') > 0:
-        key = s[:s.index(':')]
-        k = pynote.from_string(key).pitch_class
-        maj = key.isupper()
-      else:
-        if pychord.is_valid_numeral(s):
-          j = i - 1
-          while j >= 0 and not _is_beat_label(toks[j]):
-            j -= 1
-          if j < 0:
-            beat = 1
-          else:
-            beat = float(toks[j][1:]) 
-          start = get_beat(beat, top, bot)
-          stop = start
-          result.append((0, m_num, float(start), float(stop), k, maj,
-              pychord.numeral_reformatted(s)))
-  f.close()
-  for i, lab in enumerate(result):
-    s, m, start, stop, k, maj, r = lab
-    if i + 1 < len(result) and result[i + 1][1] == m:
-      result[i] = s, m, start, result[i + 1][2], k, maj, r
-    else:
-      result[i] = s, m, start, float(numbeats), k, maj, r
+        k, maj = _key(s)
+        maj = 1 if maj else 0
+        continue
+      i = _numeral_id(s)
+      if i >= 0:
+        b = get_beat(beat, top, bot)
+        if len(to_end) > 0 and measure[to_end[-1]] == m_num:
+          stop[to_end.pop()] = float(b)
+        to_end.append(len(measure))
+        measure.append(m_num)
+        start.append(float(b))
+        stop.append(0.0)
+        key.append(k)
+        major.append(maj)
+        numeral.append(i)
+      b = _beat(s)
+      if not b == None:
+        beat = b
+
+  for i in to_end:
+    stop[i] = float(numbeats)
+  return result
 
-  objresult = []
-  for s, m, start, stop, key, maj, r in result:
-    objresult.append(label.Label(s, m, start, stop, key, maj, r))
-  return objresult
+"""
+Reads every analysis in the directory path.  Returns a dict from file name
+to Analysis, in order of file name
+"""
+def read_directory(path):
+  result = dict()
+  for name in sorted(os.listdir(path)):
+    filename = os.path.join(path, name)
+    if not os.path.isfile(filename):
+      continue
+    f = open(filename, 'rb')
+    text = f.read().decode('utf-8', 'replace')
+    f.close()
+    result[name] = parse(text)
+  return result
 
 """
 Transforms beat from analysis scale to music21 scale
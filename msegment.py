@@ -0,0 +1,91 @@
+"""
+Exact segmentation of a piece into labels by dynamic programming.
+
+label_measure in mlabel chooses the labels of a measure greedily, one
+position at a time.  Here every way of covering the eighth notes of the
+piece with candidate labels is scored as the sum, over the chosen labels,
+of template distance plus markov_factor * (1 - P(previous numeral -> this
+numeral)), and the cheapest covering is found by dynamic programming over
+eighth note positions.  The state at a position is the numeral and key of
+the last label, so a measure costs O(positions * candidates^2) and the
+Markov term carries across barlines exactly as in label_measure: always
+inside a measure, and across a barline only when the key stays the same.
+"""
+
+# cost of leaving an eighth note unlabeled.  label_measure skips a position
+# only when every candidate there costs at least this much, and candidates
+# that cost more are never chosen after the start of a measure
+gap_cost = 100
+
+"""
+Takes a list with the candidate labels of each measure of the piece, in
+order, and returns the cheapest labeling as one list of labels.
+first_bound is the bound on where a measure's first label may stop, as in
+label_measure
+"""
+def label_measures(measures, model, mark_len, first_bound, markov_factor):
+  frontier = {None: (0, None, None, None)}
+  for candidates in measures:
+    frontier = _label_measure(candidates, frontier, model, mark_len,
+        first_bound, markov_factor)
+
+  node = min(frontier.values(), key=lambda n: n[0])
+  result = []
+  while node:
+    cost, last, chosen, back = node
+    if chosen:
+      result.append(chosen)
+    node = back
+  result.reverse()
+  return result
+
+"""
+Advances the dynamic program over one measure.  frontier maps each state
+at the start of the measure to its node (cost, last label, label chosen on
+the way in or None for a gap, previous node); the states at the end of the
+measure are returned the same way
+"""
+def _label_measure(candidates, frontier, model, mark_len, first_bound,
+    markov_factor):
+  by_start = [[] for i in range(mark_len)]
+  for lab in candidates:
+    if lab.start_int < mark_len:
+      by_start[lab.start_int].append(lab)
+  best = [dict() for i in range(mark_len + 1)]
+
+  firsts = [lab for lab in by_start[0] if lab.stop_int < first_bound]
+  for node in frontier.values():
+    cost, last = node[0], node[1]
+    for lab in firsts:
+      c = lab.score
+      if last and last.key == lab.key:
+        c += markov_factor * (1 - model.score(last.rn, lab.rn))
+      _relax(best[lab.stop_int], cost + c, lab, lab, node)
+    _relax(best[1], cost + gap_cost, last, None, node)
+
+  for pos in range(1, mark_len):
+    labs = by_start[pos]
+    ids = model.symbol_ids([lab.rn for lab in labs])
+    for node in list(best[pos].values()):
+      cost, last = node[0], node[1]
+      _relax(best[pos + 1], cost + gap_cost, last, None, node)
+      if len(labs) == 0:
+        continue
+      if last:
+        scores = model.score_many(model.symbol_id(last.rn), ids)
+      else:
+        scores = [1] * len(labs)
+      for lab, sc in zip(labs, scores):
+        c = lab.score + markov_factor * (1 - float(sc))
+        if c < gap_cost:
+          _relax(best[lab.stop_int], cost + c, lab, lab, node)
+
+  return best[mark_len]
+
+def _relax(states, cost, last, chosen, back):
+  if last:
+    key = (last.rn, last.key)
+  else:
+    key = None
+  if not key in states or cost < states[key][0]:
+    states[key] = (cost, last, chosen, back)
@@ -0,0 +1,277 @@
+import copy
+import itertools
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+# first, for the startup report (see mprofile)
+import mprofile
+
+import efficient
+import label
+import menumerate
+import mevaluate
+import mkeys
+import mlabel
+import mmarkov
+import mreader
+import mutils
+import refinements
+import section
+import windowstore
+
+"""
+Sweeps the parameters of the analysis over a grid and scores every point
+against the reference analyses.  The parameters are the weight of the
+markov model (mlabel.markov_factor), the weights of passing tones and of
+other notes in the template histograms (section.passing_weight and
+section.nonpassing_weight) and the distance between different bottoms
+(section.bottom_penalty):
+
+$ python msweep.py --markov=0.4,0.8,1.2 --passing=0.25,0.5,1 --bottom=1,2,4
+
+Each movement is analyzed by one worker process, which computes what does
+not depend on the parameters once, whatever the size of the grid: the
+parsed score (cached on disk by scorecache), the keys, and the notes of
+every window and what the refinements read from them.  The template
+distances of the windows depend only on the weights, and the candidates
+of each measure only on the weights and the bottom penalty, so the grid
+is visited with the markov factor changing fastest and each of those is
+recomputed only when its own parameters change.  Only segmentation and
+the refinements run for every point
+"""
+
+"""
+A point of the grid
+"""
+class Parameters(object):
+
+  __slots__ = ('passing', 'nonpassing', 'bottom', 'markov')
+
+  def __init__(self, passing=section.passing_weight,
+      nonpassing=section.nonpassing_weight, bottom=section.bottom_penalty,
+      markov=mlabel.markov_factor):
+    self.passing = passing
+    self.nonpassing = nonpassing
+    self.bottom = bottom
+    self.markov = markov
+
+  def __repr__(self):
+    return 'Parameters(passing={0}, nonpassing={1}, bottom={2}, markov={3})'\
+        .format(self.passing, self.nonpassing, self.bottom, self.markov)
+
+"""
+Returns the list of Parameters for every combination of the given values,
+ordered so that later parameters change fastest
+"""
+def grid(passing, nonpassing, bottom, markov):
+  return [Parameters(*p) for p in itertools.product(passing, nonpassing,
+    bottom, markov)]
+
+"""
+The windows of a score with what is known about them before any parameter
+is chosen, and the template distances and candidates of the weights and
+bottom penalty used last
+"""
+class Windows(object):
+
+  def __init__(self, es, sectionaries, keylist):
+    ts = es.time_sig
+    to_check = menumerate.sections_to_check(ts.numerator, ts.denominator)
+    self.mark_len = int(round(2 * max([b for a, b in to_check])))
+    self.sectionaries = sectionaries
+    # shared by the refinements at every point
+    self.store = windowstore.WindowStore(es)
+    # (measure, start, stop, key, major, notes) per window, by measure
+    self.measures = []
+    for i, m in enumerate(es.measure_nums):
+      windows = []
+      for start, stop in to_check:
+        k, maj = keylist[i * self.mark_len + int(round(start * 2))]
+        windows.append((m, start, stop, k, maj,
+          self.store.window(m, start, stop, k, maj).notes))
+      self.measures.append(windows)
+    self.weights = None
+    self.terms = None
+    self.bottom = None
+    self.candidates = None
+
+  """
+  Returns a list per measure of (pitch distances, bottom) per window, as
+  section.Sectionary.pitch_distances with the given weights
+  """
+  def distance_terms(self, passing, nonpassing):
+    if not self.weights == (passing, nonpassing):
+      self.terms = []
+      for windows in self.measures:
+        terms = []
+        for m, start, stop, k, maj, notes in windows:
+          nsec = section.from_notes(notes, k, passing, nonpassing)
+          terms.append((self.sectionary(maj).pitch_distances(nsec),
+            nsec.bottom))
+        self.terms.append(terms)
+      self.weights = (passing, nonpassing)
+      self.candidates = None
+    return self.terms
+
+  """
+  Returns the candidate labels of every measure, as returned by
+  mlabel.measure_candidates, for the parameters p
+  """
+  def measure_candidates(self, p):
+    terms = self.distance_terms(p.passing, p.nonpassing)
+    if self.candidates == None or not self.bottom == p.bottom:
+      self.candidates = []
+      for windows, window_terms in zip(self.measures, terms):
+        results = []
+        for (m, start, stop, k, maj, notes), (d, bottom) in zip(windows,
+            window_terms):
+          sectionary = self.sectionary(maj)
+          d = d + sectionary.bottom_distances(bottom, p.bottom)
+          results.extend([label.Label(s, m, start, stop, k, maj, rn)
+            for s, rn in sectionary.best(d, 3)])
+        results.sort(key=lambda x: x.score)
+        self.candidates.append(results)
+      self.bottom = p.bottom
+    return self.candidates
+
+  def sectionary(self, major):
+    if major:
+      return self.sectionaries[0]
+    return self.sectionaries[1]
+
+"""
+Yields the refined labels of the score es with keys keylist for each of
+the Parameters in points, in order
+"""
+def sweep_score(es, keylist, model, sectionaries, points, segmenter='greedy'):
+  windows = Windows(es, sectionaries, keylist)
+  for p in points:
+    labels = mlabel.segment(es, windows.measure_candidates(p), model,
+        windows.mark_len, segmenter, p.markov)
+    # the refinements change labels in place, and the candidates are reused
+    yield refinements.refine([copy.copy(lab) for lab in labels], es,
+        windows.store)
+
+# models and grid shared by every movement swept in a worker process
+_worker_state = None
+
+def _init_worker(key_model, model, sectionaries, points, segmenter):
+  global _worker_state
+  _worker_state = (key_model, model, sectionaries, points, segmenter)
+
+"""
+Returns the Accuracy of the movement called name at each point of the
+grid, or None if it has no reference analysis
+"""
+def sweep_movement(name):
+  key_model, model, sectionaries, points, segmenter = _worker_state
+  reference = mreader.read_file(mutils.analysis(name))
+  if reference == None:
+    return None
+  es = efficient.EfficientScore(mutils.sonata(name))
+  keylist = mlabel.score_keys(es, key_model)
+  return [mevaluate.evaluate(mevaluate.from_labels(labels), reference)
+      for labels in sweep_score(es, keylist, model, sectionaries, points,
+        segmenter)]
+
+"""
+Sweeps every movement in names over the Parameters in points with a pool
+of jobs worker processes (one per cpu if jobs is None).  Returns the total
+Accuracy over the movements at each point, and the number of movements
+with a reference analysis
+"""
+def sweep(names, points, key_model, model, sectionaries, jobs=None,
+    segmenter='greedy'):
+  totals = [mevaluate.Accuracy() for p in points]
+  if jobs == 1:
+    _init_worker(key_model, model, sectionaries, points, segmenter)
+    results = map(sweep_movement, names)
+  else:
+    executor = ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+        initargs=(key_model, model, sectionaries, points, segmenter))
+    results = executor.map(sweep_movement, names)
+  found = 0
+  try:
+    for name, accuracies in zip(names, results):
+      mprofile.mark('sweep ' + name)
+      if accuracies == None:
+        continue
+      found += 1
+      totals = [t + acc for t, acc in zip(totals, accuracies)]
+  finally:
+    if not jobs == 1:
+      executor.shutdown()
+  return totals, found
+
+"""
+Writes a table of the accuracy at each point of the grid, in the format of
+mevaluate.report with the parameters in place of the movement, followed
+by the points with the best numeral and reduced accuracy
+"""
+def report(points, totals, out=sys.stdout):
+  header = '{0:>8}{1:>8}{2:>8}{3:>8}'
+  row = '{0:>8g}{1:>8g}{2:>8g}{3:>8g}'
+  out.write((header + '{4:>8}{5:>8}{6:>10}{7:>10}\n').format('markov',
+    'passing', 'nonpass', 'bottom', 'eighths', 'key', 'numeral', 'reduced'))
+  for p, acc in zip(points, totals):
+    out.write((row + '{4:>8}{5:>8.3f}{6:>10.3f}{7:>10.3f}\n').format(
+      p.markov, p.passing, p.nonpassing, p.bottom, acc.eighths, *acc.rates()))
+  if len(points) == 0:
+    return
+  for name, i in (('numeral', 1), ('reduced', 2)):
+    best = max(range(len(points)), key=lambda j: totals[j].rates()[i])
+    out.write('best {0} {1:.3f} at {2}\n'.format(name,
+      totals[best].rates()[i], points[best]))
+
+"""
+Parses a comma separated list of numbers
+"""
+def values(arg):
+  return [float(x) for x in arg.split(',')]
+
+"""
+Sweeps the movements given on the command line, or every movement with a
+reference analysis if none are given.  Parameters left out keep their
+usual value
+"""
+def main():
+  args = mprofile.take_option(sys.argv[1:])
+  options = {
+    'passing': [section.passing_weight],
+    'nonpassing': [section.nonpassing_weight],
+    'bottom': [section.bottom_penalty],
+    'markov': [mlabel.markov_factor]
+  }
+  jobs = None
+  segmenter = 'greedy'
+  names = []
+  for arg in args:
+    if arg.startswith('--jobs='):
+      jobs = int(arg[len('--jobs='):])
+    elif arg == '--dp':
+      segmenter = 'dp'
+    elif arg.startswith('--') and '=' in arg:
+      key, value = arg[2:].split('=', 1)
+      if not key in options:
+        raise ValueError('unknown option ' + arg)
+      options[key] = values(value)
+    else:
+      names.append(arg)
+  if len(names) == 0:
+    names = mevaluate.movement_names()
+
+  key_model = mkeys.hmm_from_training_dir()
+  model = mmarkov.load()
+  sectionaries = mutils.load_sectionaries()
+  mprofile.mark('models')
+
+  points = grid(options['passing'], options['nonpassing'], options['bottom'],
+      options['markov'])
+  totals, found = sweep(names, points, key_model, model, sectionaries, jobs,
+      segmenter)
+  sys.stderr.write('{0} points over {1} movements\n'.format(len(points),
+    found))
+  report(points, totals)
+
+if __name__ == '__main__':
+  main()
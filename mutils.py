@@ -1,12 +1,15 @@
 import os
 
+import numpy
+
 import label
+import labelgrid
 import pychord
 import pynote
 import section
 
 def num_eighths_in_measure(n, d):
-  return n * 8 / d
+  return n * 8 // d
 
 def no_ext(name):
   name = os.path.basename(name)
@@ -52,8 +55,20 @@ def add_slashes(s):
       result.append('/')
   return ''.join(result)
 
+"""
+Converts a labeling, as made by as_labeling, into the lines of a Dmitri
+analysis file, one per measure
+"""
 def as_dmitri_output(labels):
-  result = []
+  if isinstance(labels, labelgrid.LabelGrid):
+    return grid_dmitri_output(labels)
+  return list(iter_dmitri_output(labels))
+
+"""
+Yields the lines of as_dmitri_output one measure at a time, so labels may
+be a generator such as iter_labeling
+"""
+def iter_dmitri_output(labels):
   ck = None
   crn = None
   for i, line in enumerate(labels):
@@ -79,14 +94,67 @@ def as_dmitri_output(labels):
         elif not crn == rn:
           s = s + rn + ' '
           crn = rn
-    result.append(s)
-  return result
+    yield s
+
+"""
+as_dmitri_output for a LabelGrid.  A label is written wherever the numeral
+or key differs from the last one written, which is found for all cells at
+once; only those cells are visited one by one
+"""
+def grid_dmitri_output(grid):
+  shown = {}
+  texts = []
+  keystrs = []
+  display = numpy.empty(len(grid.values), dtype=numpy.int64)
+  for v, (rn, k, maj, score) in enumerate(grid.values):
+    rn = add_slashes(rn)
+    if not (rn, k) in shown:
+      shown[(rn, k)] = len(shown)
+    display[v] = shown[(rn, k)]
+    keystr = str(pynote.Note(k))
+    if not maj:
+      keystr = keystr.lower()
+    texts.append(rn)
+    keystrs.append(keystr)
+
+  ids = grid.ids.ravel()
+  cells = numpy.flatnonzero(ids >= 0)
+  ids = ids[cells]
+  shown_ids = display[ids]
+  new = numpy.ones(len(cells), dtype=bool)
+  new[1:] = shown_ids[1:] != shown_ids[:-1]
+  cells = cells[new]
+  ids = ids[new]
+
+  measure_len = max(grid.measure_len, 1)
+  lines = ['m' + str(m) + ' ' for m in grid.measures]
+  ck = None
+  for cell, v in zip(cells.tolist(), ids.tolist()):
+    row, j = divmod(cell, measure_len)
+    s = lines[row]
+    b = 1 + float(j) / 2
+    if b == float(int(b)):
+      b = int(b)
+    if not b == 1:
+      s = s + 'b' + str(b) + ' '
+    k = grid.values[v][1]
+    if not ck == k:
+      s = s + keystrs[v] + ': '
+      ck = k
+    lines[row] = s + texts[v] + ' '
+  return lines
 
 def save_dmitri_output(name, labels):
-  f = open(dmitri_output(name), 'w')
+  filename = dmitri_output(name)
+  if not os.path.isdir(os.path.dirname(filename)):
+    os.makedirs(os.path.dirname(filename))
+  f = open(filename, 'w')
   f.write('Title: {0}\n'.format(name))
   f.write('Analyzer: Computer program by Jeffrey Hodes\n')
-  measure_dur = float(len(labels[0][1])) / 2
+  if isinstance(labels, labelgrid.LabelGrid):
+    measure_dur = float(labels.measure_len) / 2
+  else:
+    measure_dur = float(len(labels[0][1])) / 2
   f.write('Measure duration: ' + str(measure_dur) +'\n')
   for line in as_dmitri_output(labels):
     f.write(line + '\n')
@@ -127,28 +195,39 @@ def load_sectionary(filename):
     s = section.from_string(gp)
     if s:
       result.append(s)
-  return result
+  return section.Sectionary(result)
 
 """
 Converts a list of sections into a list of measures, each of which is a
-list of eighth beats
+list of eighth beats, returned as a labelgrid.LabelGrid
 """
 def as_labeling(labels):
-  measure_len = max([lab.stop_int for lab in labels])
-  measure_nums = sorted(list(set([lab.measure for lab in labels])))
-  result = []
-  for m in measure_nums:
-    measure = [None for i in range(measure_len)]
-    labs = [lab for lab in labels if lab.measure == m]
-    for lab in labs:
-      for i in range(lab.start_int, lab.stop_int):
-        measure[i] = (lab.rn, lab.key, lab.major, lab.score)
-    result.append((m, measure))
-  
-  for m, measure in result:
-    for i, p in enumerate(measure):
-      if not p:
-        if i > 0:
-          measure[i] = measure[i - 1]
-  return result
- 
+  return labelgrid.from_labels(labels)
+
+"""
+Yields the measures of as_labeling one at a time from labels ordered by
+measure, as soon as the labels of each measure are complete.  measure_len
+is the number of eighth notes in a measure
+"""
+def iter_labeling(labels, measure_len):
+  m = None
+  labs = []
+  for lab in labels:
+    if not lab.measure == m and len(labs) > 0:
+      yield _labeling_row(m, labs, measure_len)
+      labs = []
+    m = lab.measure
+    labs.append(lab)
+  if len(labs) > 0:
+    yield _labeling_row(m, labs, measure_len)
+
+def _labeling_row(m, labs, measure_len):
+  measure = [None for i in range(measure_len)]
+  for lab in labs:
+    for i in range(lab.start_int, lab.stop_int):
+      measure[i] = (lab.rn, lab.key, lab.major, lab.score)
+  for i, p in enumerate(measure):
+    if not p:
+      if i > 0:
+        measure[i] = measure[i - 1]
+  return (m, measure)
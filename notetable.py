@@ -0,0 +1,95 @@
+from array import array
+from bisect import bisect_left
+
+"""
+Column-oriented store of notes.  Every pitch of every note or chord is one
+row; the columns are parallel arrays so that a score holds a handful of
+arrays per measure instead of one music21 object per pitch.
+
+midi: MIDI number
+pitch_class: pitch class
+offset: offset from the beginning of the measure in quarter notes
+end: offset + duration
+duration: duration in quarter notes
+passing: 1 if the note is a passing tone, 0 otherwise
+"""
+class NoteTable(object):
+
+  __slots__ = ('midi', 'pitch_class', 'offset', 'end', 'duration', 'passing',
+      'max_duration')
+
+  def __init__(self, midi=(), pitch_class=(), offset=(), end=(),
+      duration=(), passing=()):
+    self.midi = array('h', midi)
+    self.pitch_class = array('b', pitch_class)
+    self.offset = array('d', offset)
+    self.end = array('d', end)
+    self.duration = array('d', duration)
+    self.passing = array('b', passing)
+    self.max_duration = max(self.duration) if len(self.duration) > 0 else 0
+
+  def __len__(self):
+    return len(self.midi)
+
+  """
+  Returns the notes sounding in [start, stop) as a new table.  Matches
+  music21's getElementsByOffset(start, stop, includeEndBoundary=False,
+  mustBeginInSpan=False): notes that end exactly at start are included.
+  Rows must be sorted by offset, as they are in tables made by from_rows
+  """
+  def window(self, start, stop):
+    lo = bisect_left(self.offset, start - self.max_duration)
+    hi = bisect_left(self.offset, stop)
+    end = self.end
+    return self.take([i for i in range(lo, hi) if end[i] >= start])
+
+  """
+  Returns a new table with the given rows
+  """
+  def take(self, rows):
+    return NoteTable([self.midi[i] for i in rows],
+        [self.pitch_class[i] for i in rows],
+        [self.offset[i] for i in rows],
+        [self.end[i] for i in rows],
+        [self.duration[i] for i in rows],
+        [self.passing[i] for i in rows])
+
+  def pitch_class_set(self):
+    return set(self.pitch_class)
+
+  """
+  Returns the row of the lowest note (the earliest one if several share
+  the lowest pitch), or None if the table is empty
+  """
+  def lowest(self):
+    if len(self.midi) == 0:
+      return None
+    return min(range(len(self.midi)),
+        key=lambda i: (self.midi[i], self.offset[i]))
+
+  def bass_midi(self):
+    i = self.lowest()
+    if i == None:
+      return None
+    return self.midi[i]
+
+  def bass_pitch_class(self):
+    i = self.lowest()
+    if i == None:
+      return None
+    return self.pitch_class[i]
+
+  def __repr__(self):
+    return 'NoteTable({0})'.format(', '.join(
+      '{0}@{1}+{2}'.format(self.midi[i], self.offset[i], self.duration[i])
+      for i in range(len(self))))
+
+"""
+Builds a table from tuples (midi, pitch_class, offset, end, duration,
+passing), sorting them by offset
+"""
+def from_rows(rows):
+  rows = sorted(rows, key=lambda r: r[2])
+  if len(rows) == 0:
+    return NoteTable()
+  return NoteTable(*zip(*rows))
@@ -0,0 +1,47 @@
+import os
+import pickle
+
+"""
+Files holding one pickled value tagged with a format version, as used for
+the compiled key model (mkeys), the score cache (scorecache) and the
+binary Markov model (mmarkov).  A file written by another version of the
+format reads as missing, so callers rebuild it
+"""
+
+"""
+Pickles contents to filename tagged with version, creating its directory
+if needed.  The file is written under a temporary name and then renamed,
+so concurrent jobs never see half a file.  Raises IOError or OSError if
+it cannot be written, leaving no temporary file behind
+"""
+def save(filename, version, contents):
+  tmp = '{0}.{1}.tmp'.format(filename, os.getpid())
+  try:
+    path = os.path.dirname(filename)
+    if path and not os.path.isdir(path):
+      os.makedirs(path)
+    f = open(tmp, 'wb')
+    pickle.dump((version, contents), f, pickle.HIGHEST_PROTOCOL)
+    f.close()
+    os.replace(tmp, filename)
+  except (IOError, OSError):
+    if os.path.exists(tmp):
+      os.remove(tmp)
+    raise
+
+"""
+Returns the contents pickled to filename by save, or None if the file is
+missing, unreadable or of another version
+"""
+def load(filename, version):
+  if not os.path.exists(filename):
+    return None
+  try:
+    f = open(filename, 'rb')
+    saved_version, contents = pickle.load(f)
+    f.close()
+  except Exception:
+    return None
+  if not saved_version == version:
+    return None
+  return contents
@@ -1,3 +1,7 @@
+from functools import lru_cache
+
+import numpy
+
 import pynote
 
 """
@@ -92,28 +96,65 @@ class Chord:
           return s
       return None
 
+"""
+Returns the 12 bit mask of a collection of pitch classes, with bit p set
+for pitch class p
+"""
+def pitch_class_mask(pitch_classes):
+    mask = 0
+    for p in pitch_classes:
+        mask |= 1 << p
+    return mask
+
+"""
+Tables indexed by pitch class mask giving the index in Chord.TEMPLATES and
+the root of the chord with exactly those pitch classes, or -1.  Where
+several templates or roots fit, the first in TEMPLATES order and then root
+order wins
+"""
+def _chord_tables():
+    templates = numpy.full(4096, -1, dtype=int)
+    roots = numpy.full(4096, -1, dtype=int)
+    for i, (template, name) in enumerate(Chord.TEMPLATES):
+        for k in range(12):
+            mask = pitch_class_mask([(p + k) % 12 for p in template])
+            if templates[mask] == -1:
+                templates[mask] = i
+                roots[mask] = k
+    return templates, roots
+
+TEMPLATE_BY_MASK, ROOT_BY_MASK = _chord_tables()
+
+"""
+Identifies the chords for an array of pitch class masks at once.  Returns
+a pair of arrays (template index, root), with -1 where no template fits
+"""
+def identify_masks(masks):
+    masks = numpy.asarray(masks, dtype=int)
+    return TEMPLATE_BY_MASK[masks], ROOT_BY_MASK[masks]
+
 def from_notes(notes):
     pitch_classes = set([n.pitch_class for n in notes])
-    for template, name in Chord.TEMPLATES:
-        for k in range(12):
-            ps = set([(p - k) % 12 for p in pitch_classes])
-            if ps == template:
-                root = [n for n in notes if n.pitch_class == k][0]
-
-                bass = min([(n.octave, n.pitch_class) for n in notes])
-                bass_pc = (bass[1] - k) % 12
-                
-                if bass_pc in [3, 4]:
-                    inversion = 1
-                elif bass_pc in [6, 7, 8]:
-                    inversion = 2
-                elif bass_pc in [9, 10, 11]:
-                    inversion = 3
-                else:
-                    inversion = 0
-
-                return Chord(root.pitch_class, name, inversion, pitch_classes)
-    return None
+    mask = pitch_class_mask(pitch_classes)
+    i = TEMPLATE_BY_MASK[mask]
+    if i == -1:
+        return None
+    name = Chord.TEMPLATES[i][1]
+    k = int(ROOT_BY_MASK[mask])
+
+    bass = min([(n.octave, n.pitch_class) for n in notes])
+    bass_pc = (bass[1] - k) % 12
+    
+    if bass_pc in [3, 4]:
+        inversion = 1
+    elif bass_pc in [6, 7, 8]:
+        inversion = 2
+    elif bass_pc in [9, 10, 11]:
+        inversion = 3
+    else:
+        inversion = 0
+
+    return Chord(k, name, inversion, pitch_classes)
 
 def from_music21_chord(c):
   if c.isRest:
@@ -132,34 +173,85 @@ def with_slash(s):
   return ''.join(result)
 
 
+"""
+A roman numeral string parsed once.  Every field is derived from text alone,
+so parse_numeral hands out one shared, read-only Numeral per string:
+
+numeral: the leading roman numeral (just_numeral)
+numeral_with_secondary: numeral and secondary numeral 
+  (just_numeral_with_secondary)
+reformatted: text with the slash inside the inversion removed
+  (numeral_reformatted)
+interval: semitones from the tonic to the root (interval_from_tonic)
+valid: whether text is a valid roman numeral (is_valid_numeral)
+degree: index of the numeral in Chord.NUMERALS, or None
+quality: 'major', 'minor', 'diminished', 'half-diminished', 'augmented',
+  or None for anything that is not a roman numeral
+inversion: the inversion figures, such as '', '6', '65'
+secondary: the numeral after the slash of an applied chord, or None
+"""
+class Numeral(object):
+
+    __slots__ = ('text', 'numeral', 'numeral_with_secondary', 'reformatted',
+        'interval', 'valid', 'degree', 'quality', 'inversion', 'secondary',
+        'chord_spec')
+
+    def __init__(self, s):
+        self.text = s
+        self.numeral = _leading_numeral(s)
+        self.numeral_with_secondary = _numeral_with_secondary(s)
+        self.reformatted = _reformatted(s)
+        self.interval = _interval_from_tonic(s)
+        self.valid = _is_valid_numeral(s)
+
+        if self.numeral.upper() in Chord.NUMERALS:
+            self.degree = Chord.NUMERALS.index(self.numeral.upper())
+        else:
+            self.degree = None
+
+        secondary, rn, _ = _split_secondary(s)
+        self.secondary = secondary
+        rest = rn[len(_leading_numeral(rn)):]
+        self.inversion = ''.join([c for c in rest if c in '234567'])
+        if self.degree == None:
+            self.quality = None
+        elif '+' in rest:
+            self.quality = 'augmented'
+        elif is_half_diminished(rest):
+            self.quality = 'half-diminished'
+        elif 'o' in rest:
+            self.quality = 'diminished'
+        elif self.numeral.isupper():
+            self.quality = 'major'
+        else:
+            self.quality = 'minor'
+
+        # key independent part of from_numeral_and_key
+        self.chord_spec = _chord_spec(s)
+
+    def __repr__(self):
+        return 'Numeral({0!r})'.format(self.text)
+
+"""
+Returns the Numeral for the string s.  The distinct numerals in an analysis
+number in the hundreds, so nearly every call is a cache hit
+"""
+@lru_cache(maxsize=4096)
+def parse_numeral(s):
+    return Numeral(s)
+
 def just_numeral(s):
-    i = 0
-    while i < len(s) and s[i] in 'ivIV':
-        i += 1
-    return s[:i]
+    return parse_numeral(s).numeral
 
 def just_numeral_with_secondary(s):
-  if not '/' in s:
-    return just_numeral(s)
-  j = s.index('/')
-  before = s[:j]
-  after = s[j + 1:]
-  result = just_numeral(before) + '/' + just_numeral(after)
-  if result[-1] == '/':
-    return result[:-1]
-  return result
+    return parse_numeral(s).numeral_with_secondary
 
 """
 Returns the roman numeral s with the slash between the two numbers of the
 inversion removed, so that for example ii6/5 becomes ii65
 """
 def numeral_reformatted(s):
-  for i, c in enumerate(s):
-    if c == '/' and 0 < i < len(s) - 1:
-      if s[i-1].isdigit() and s[i+1].isdigit():
-        return s[:i] + s[i + 1:]
-  return s
-
+    return parse_numeral(s).reformatted
 
 """
 Returns the number of semitones above the tonic the root
@@ -176,20 +268,51 @@ VI -> 8 (since VI occurs in minor)
 iii -> 4
 """
 def interval_from_tonic(s):
-    if not just_numeral(s).upper() in Chord.NUMERALS:
-        return None
-    degree = Chord.NUMERALS.index(just_numeral(s).upper())
-    candidates = Chord.NUMERAL_CLASSES[degree]
-    if len(candidates) == 1 or just_numeral(s).isupper():
-        return candidates[0]
-    else:
-        return candidates[1]
+    return parse_numeral(s).interval
 
 """
 Returns True if s is a valid roman numeral string and
 False otherwise.
 """
 def is_valid_numeral(rn):
+    return parse_numeral(rn).valid
+
+def _leading_numeral(s):
+    i = 0
+    while i < len(s) and s[i] in 'ivIV':
+        i += 1
+    return s[:i]
+
+def _numeral_with_secondary(s):
+  if not '/' in s:
+    return _leading_numeral(s)
+  j = s.index('/')
+  before = s[:j]
+  after = s[j + 1:]
+  result = _leading_numeral(before) + '/' + _leading_numeral(after)
+  if result[-1] == '/':
+    return result[:-1]
+  return result
+
+def _reformatted(s):
+  for i, c in enumerate(s):
+    if c == '/' and 0 < i < len(s) - 1:
+      if s[i-1].isdigit() and s[i+1].isdigit():
+        return s[:i] + s[i + 1:]
+  return s
+
+def _interval_from_tonic(s):
+    numeral = _leading_numeral(s)
+    if not numeral.upper() in Chord.NUMERALS:
+        return None
+    degree = Chord.NUMERALS.index(numeral.upper())
+    candidates = Chord.NUMERAL_CLASSES[degree]
+    if len(candidates) == 1 or numeral.isupper():
+        return candidates[0]
+    else:
+        return candidates[1]
+
+def _is_valid_numeral(rn):
     if len(rn) == 0:
         return False
     chars = 'iIvVN+o/234567'
@@ -200,6 +323,20 @@ def is_valid_numeral(rn):
         return False
     return True
 
+"""
+Splits an applied chord such as V7/V into its secondary numeral, the chord
+numeral and the key change in semitones: ('V', 'V7', 7).  Returns
+(None, rn, 0) if rn is not an applied chord
+"""
+def _split_secondary(rn):
+    last_slash_index = last_index(rn, '/')
+    if last_slash_index:
+        secondary = rn[last_slash_index + 1:]
+        if secondary.upper() in Chord.NUMERALS:
+            return (secondary, rn[:last_slash_index], 
+                _interval_from_tonic(secondary))
+    return None, rn, 0
+
 def is_augmented(s):
     return '+' in s
 
@@ -241,17 +378,27 @@ Allowed roman numerals:
 [upper/lower case numeral] [+ | o] [inversion numbers]
 """
 def from_numeral_and_key(rn, k):
-    last_slash_index = last_index(rn, '/')
-    if last_slash_index:
-        secondary = rn[last_slash_index + 1:]
-        if secondary.upper() in Chord.NUMERALS:
-            diff = interval_from_tonic(secondary)
-            k = (k + diff) % 12
-            rn = rn[:last_slash_index]
-    
+    spec = parse_numeral(rn).chord_spec
+    if spec == None:
+        return None
+    diff, root, name, inversion, ps = spec
+    k = (k + diff) % 12
+
+    shifted_ps = set([(x + k + root) % 12 for x in ps])
+    root = (root + k) % 12
+
+    return Chord(root, name, inversion, shifted_ps)
+
+"""
+Returns the key independent part of from_numeral_and_key(rn, k) as a tuple
+(key change of the secondary, root interval, name, inversion, pitch classes
+above the root), or None if rn is malformed
+"""
+def _chord_spec(rn):
+    _, rn, diff = _split_secondary(rn)
     
-    s = just_numeral(rn)
-    root = interval_from_tonic(s)
+    s = _leading_numeral(rn)
+    root = _interval_from_tonic(s)
 
     if root == None:
         return None
@@ -275,7 +422,7 @@ def from_numeral_and_key(rn, k):
         
     if inversion_name in Chord.INVERSIONS:
         inversion = Chord.INVERSIONS.index(inversion_name)
-        ps = set([0, third, fifth])
+        ps = frozenset([0, third, fifth])
         name = name_from_pitch_classes(ps)
     elif inversion_name in Chord.SEVENTH_INVERSIONS:
         inversion = Chord.SEVENTH_INVERSIONS.index(inversion_name)
@@ -285,13 +432,9 @@ def from_numeral_and_key(rn, k):
             seventh = 11
         else:
             seventh = 10
-        ps = set([0, third, fifth, seventh])
+        ps = frozenset([0, third, fifth, seventh])
         name = name_from_pitch_classes(ps)
     else:
         return None
    
-    shifted_ps = set([(x + k + root) % 12 for x in ps])
-    root = (root + k) % 12
-
-    return Chord(root, name, inversion, shifted_ps)
-
+    return diff, root, name, inversion, ps
@@ -1,64 +1,154 @@
+from collections import deque
+
+import mprofile
 import pychord
-import section
+import windowstore
 
 """
-Methods that act on lists of sections to make them better
+Methods that act on lists of sections to make them better.
+
+Each refinement is a Rule that looks at a window of a few consecutive
+labels.  refine and stream_refine run all of them in a single pass over
+the labels: every label moves through the rules in order, and each rule
+holds back only as many labels as its window needs, so the whole chain
+looks at most a few labels ahead.  The result is the same as running the
+rules one after another over the whole list
 """
 
-def fill_gaps(labels):
+"""
+A refinement applied to every window of width consecutive labels, in
+order.  fix(window, context) changes the labels of the window in place and
+returns a label of the window that should be left out of the output, or
+None.  A label that is left out still takes part in the windows after it
+"""
+class Rule(object):
+
+  def __init__(self, name, width, fix):
+    self.name = name
+    self.width = width
+    self.fix = fix
+
+  def __repr__(self):
+    return 'Rule({0}, {1})'.format(self.name, self.width)
+
+"""
+What the rules know about the piece: the score, the number of eighth notes
+in a measure and the windowstore.WindowStore holding the notes under each
+label's span.  Without a store of its own a context keeps the windows of
+the last cache_size spans
+"""
+class Context(object):
+
+  cache_size = 256
+
+  def __init__(self, es, measure_len, store=None):
+    self.es = es
+    self.measure_len = measure_len
+    if store == None:
+      store = windowstore.WindowStore(es, size=self.cache_size)
+    self.store = store
+
+  """
+  Returns (bass MIDI number, bass pitch class, set of pitch classes) of the
+  notes under the span of lab, computing it only once per span
+  """
+  def notes(self, lab):
+    return self.store.label_window(lab).summary()[:3]
+
+"""
+Runs every rule on the labels of a piece.  store is the WindowStore of
+the score the labels were chosen from, if there is one
+"""
+def refine(labels, es, store=None):
   measure_len = max([lab.stop_int for lab in labels])
-  result = []
-  for s1, s2 in zip(labels, labels[1:]):
-    if s2.measure > s1.measure:
-      if s1.stop_int < measure_len:
-        s1.set_stop(float(measure_len) / 2)
-        result.append(s1)
-      else:
-        result.append(s1)
-    else:
-      if s1.stop == s2.start:
-        result.append(s1)
+  return list(stream_refine(labels, es, measure_len, store=store))
+
+def stream_refine(labels, es, measure_len, rules=None, store=None):
+  if rules == None:
+    rules = RULES
+  return apply_rules(rules, labels, Context(es, measure_len, store))
+
+"""
+Runs the rules over an iterable of labels in one pass, yielding each
+label once every rule is done with it
+"""
+def apply_rules(rules, labels, context):
+  windows = [deque() for rule in rules]
+  dropped = [set() for rule in rules]
+  fixes = [mprofile.timed('refine ' + rule.name, rule.fix) for rule in rules]
+  out = []
+
+  # moves lab into the window of rule k, and on through the following rules
+  # as windows fill up, collecting the labels that come out the end in out
+  def push(k, lab):
+    while k < len(rules):
+      window = windows[k]
+      window.append(lab)
+      if len(window) < rules[k].width:
+        return
+      drop = fixes[k](window, context)
+      if drop:
+        dropped[k].add(id(drop))
+      lab = window.popleft()
+      if id(lab) in dropped[k]:
+        dropped[k].discard(id(lab))
+        return
+      k += 1
+    out.append(lab)
+
+  for lab in labels:
+    push(0, lab)
+    for x in out:
+      yield x
+    del out[:]
+
+  for k in range(len(rules)):
+    while len(windows[k]) > 0:
+      lab = windows[k].popleft()
+      if id(lab) in dropped[k]:
+        dropped[k].discard(id(lab))
       else:
-        s1.set_stop(s2.start)
-        result.append(s1)
-  result.append(labels[-1])
-  return result
+        push(k + 1, lab)
+  for x in out:
+    yield x
+
+def _apply_rule(rule, labels, es=None, measure_len=None):
+  return list(apply_rules([rule], labels, Context(es, measure_len)))
+
+def fill_gaps(labels):
+  measure_len = max([lab.stop_int for lab in labels])
+  return _apply_rule(FILL_GAPS, labels, measure_len=measure_len)
+
+def _fill_gap(window, context):
+  s1, s2 = window
+  if s2.measure > s1.measure:
+    if s1.stop_int < context.measure_len:
+      s1.set_stop(float(context.measure_len) / 2)
+  else:
+    if not s1.stop == s2.start:
+      s1.set_stop(s2.start)
 
 def join_adjacents(labels):
-  result = labels[:]
-  toremove = []
-  N = len(result)
-  for i in range(N):
-    if i < N - 1:
-      a = result[i]
-      b = result[i + 1]
-      if a.measure == b.measure and a.rn == b.rn:
-        a.stop = b.stop
-        a.stop_int = b.stop_int
-        toremove.append(b)
-        result[i] = a
-
-  for s in toremove:
-    result.remove(s)
-  return result
+  return _apply_rule(JOIN_ADJACENTS, labels)
+
+def _join_adjacent(window, context):
+  a, b = window
+  if a.measure == b.measure and a.rn == b.rn:
+    a.stop = b.stop
+    a.stop_int = b.stop_int
+    return b
 
 def fix_prefixes(labels):
-  result = labels[:]
-  N = len(result)
-  for i in range(N):
-    if i < N - 1:
-      a = result[i]
-      b = result[i + 1]
-      rn1 = a.rn
-      rn2 = b.rn
-      srn2 = pychord.just_numeral_with_secondary(rn2)
-      if rn1 == 'ii2' and rn2 == 'I':
-        a.rn = 'I'
-      if rn1 == 'ii7':
-        a.rn = 'I6'
-      result[i] = a
-      result[i+1] = b
-  return result
+  return _apply_rule(FIX_PREFIXES, labels)
+
+def _fix_prefix(window, context):
+  a, b = window
+  rn1 = a.rn
+  rn2 = b.rn
+  if rn1 == 'ii2' and rn2 == 'I':
+    a.rn = 'I'
+  if rn1 == 'ii7':
+    a.rn = 'I6'
 
 
 
@@ -84,52 +174,38 @@ def fix_vii_to_V(labels):
 
 
 def fix_common_errors(labels, es):
-  result = labels[:]
-  N = len(result)
-  for i in range(N):
-    if i < N - 1:
-      a = result[i]
-      b = result[i + 1]
-      rn1 = a.rn
-      rn2 = b.rn
-      srn2 = pychord.just_numeral_with_secondary(rn2)
-      if rn2 in ['I', 'I6', 'i', 'i6']:
-        notes = es.notes_in_measure(a.measure, a.start, a.stop)
-        ps = set([n.pitch.pitchClass for n in notes])
-        if (11 + a.key) % 12 in ps:
-          if rn1 == 'ii':
-            a.rn = 'viio6'
-          if rn1 == 'iio65':
-            a.rn == 'viio43'
-      result[i] = a
-      result[i+1] = b
-  return result
+  return _apply_rule(FIX_COMMON_ERRORS, labels, es)
+
+def _fix_common_error(window, context):
+  a, b = window
+  rn1 = a.rn
+  rn2 = b.rn
+  if rn2 in ['I', 'I6', 'i', 'i6']:
+    bass, bass_pc, ps = context.notes(a)
+    if (11 + a.key) % 12 in ps:
+      if rn1 == 'ii':
+        a.rn = 'viio6'
+      if rn1 == 'iio65':
+        a.rn == 'viio43'
 
 
 
 def fix_inversions(labels, es):
-  result = labels[:]
-  N = len(result)
-  for i in range(N):
-    if i < N - 1:
-      a = result[i]
-      b = result[i + 1]
-      rn1 = a.rn
-      rn2 = b.rn
-      srn1 = pychord.just_numeral_with_secondary(rn1)
-      srn2 = pychord.just_numeral_with_secondary(rn2)
-      if srn1.lower() == srn2.lower() and not rn1 == rn2:
-        anotes = es.notes_in_measure(a.measure, a.start, a.stop)
-        bnotes = es.notes_in_measure(b.measure, b.start, b.stop)
-        abass = min(anotes, key=lambda x: x.pitch.midi).pitch.midi
-        bbass = min(bnotes, key=lambda x: x.pitch.midi).pitch.midi
-        if abass + 6 < bbass or abass == bbass:
-          b.rn = a.rn
-        if bbass + 11 < abass and ('64' in rn1 or '6/4' in rn1):
-          a.rn = b.rn
-      result[i] = a
-      result[i+1] = b
-  return result
+  return _apply_rule(FIX_INVERSIONS, labels, es)
+
+def _fix_inversion(window, context):
+  a, b = window
+  rn1 = a.rn
+  rn2 = b.rn
+  srn1 = pychord.just_numeral_with_secondary(rn1)
+  srn2 = pychord.just_numeral_with_secondary(rn2)
+  if srn1.lower() == srn2.lower() and not rn1 == rn2:
+    abass = context.notes(a)[0]
+    bbass = context.notes(b)[0]
+    if abass + 6 < bbass or abass == bbass:
+      b.rn = a.rn
+    if bbass + 11 < abass and ('64' in rn1 or '6/4' in rn1):
+      a.rn = b.rn
 
 renames = {
   'V/iv': 'I',
@@ -138,67 +214,79 @@ renames = {
 }
 
 def rename_errors(labels):
-  result = [] 
-  for lab in labels:
-    if lab.rn in renames:
-      lab.rn = renames[lab.rn]
-    result.append(lab)
-  return result
+  return _apply_rule(RENAME_ERRORS, labels)
+
+def _rename_error(window, context):
+  lab = window[0]
+  if lab.rn in renames:
+    lab.rn = renames[lab.rn]
 
 basses = [
   ('I64', 0, 'I')
 ]
 
 def fix_basses(labels, es):
-  result = []
-  for lab in labels:
-    for a, d, b in basses:
-      if lab.rn == a:
-        notes = es.notes_in_measure(lab.measure, lab.start, lab.stop)
-        bass = min(notes, key=lambda x: x.pitch.midi).pitch.pitchClass
-        if (bass - lab.key) % 12 == d:
-          lab.rn = b
-    result.append(lab)
-  return result 
+  return _apply_rule(FIX_BASSES, labels, es)
+
+def _fix_bass(window, context):
+  lab = window[0]
+  for a, d, b in basses:
+    if lab.rn == a:
+      bass = context.notes(lab)[1]
+      if (bass - lab.key) % 12 == d:
+        lab.rn = b
 
 def fix_Vs(labels, es):
-  result = []
-  for lab in labels:
-    if lab.rn == 'V':
-      notes = es.notes_in_measure(lab.measure, lab.start, lab.stop)
-      ps = [n.pitch.pitchClass for n in notes]
-      if (5 + lab.key) % 12 in ps:
-        lab.rn = 'V7'
-    if lab.rn == 'V7':
-      notes = es.notes_in_measure(lab.measure, lab.start, lab.stop)
-      ps = [n.pitch.pitchClass for n in notes]
-      if not (5 + lab.key) % 12 in ps:
-        lab.rn = 'V'
-    if lab.rn == 'viio64':
-      notes = es.notes_in_measure(lab.measure, lab.start, lab.stop)
-      ps = [n.pitch.pitchClass for n in notes]
-      if (7 + lab.key) % 12 in ps or True:
-        lab.rn = 'V2'
-    result.append(lab)
-  return result
+  return _apply_rule(FIX_VS, labels, es)
+
+def _fix_V(window, context):
+  lab = window[0]
+  if lab.rn == 'V':
+    ps = context.notes(lab)[2]
+    if (5 + lab.key) % 12 in ps:
+      lab.rn = 'V7'
+  if lab.rn == 'V7':
+    ps = context.notes(lab)[2]
+    if not (5 + lab.key) % 12 in ps:
+      lab.rn = 'V'
+  if lab.rn == 'viio64':
+    ps = context.notes(lab)[2]
+    if (7 + lab.key) % 12 in ps or True:
+      lab.rn = 'V2'
+
+triples = {
+  ('I64', 'ii65', 'I6') : 'V2',
+  ('I', 'ii2', 'I') : 'I'
+}
 
 def fix_triples(labels, es):
-  result = labels[:]
-  N = len(labels)
-  triples = {
-    ('I64', 'ii65', 'I6') : 'V2',
-    ('I', 'ii2', 'I') : 'I'
-  }
-  for i in range(N):
-    if i < N - 2:
-      rn1 = result[i].rn
-      rn2 = result[i + 1].rn
-      rn3 = result[i + 2].rn
+  return _apply_rule(FIX_TRIPLES, labels, es)
 
-      t = (rn1, rn2, rn3) 
-      if t in triples:
-        result[i + 1].rn = triples[t]
+def _fix_triple(window, context):
+  a, b, c = window
+  t = (a.rn, b.rn, c.rn)
+  if t in triples:
+    b.rn = triples[t]
 
-      st = map(pychord.just_numeral_with_secondary, t)
-  return result
- 
+FILL_GAPS = Rule('fill_gaps', 2, _fill_gap)
+FIX_PREFIXES = Rule('fix_prefixes', 2, _fix_prefix)
+FIX_TRIPLES = Rule('fix_triples', 3, _fix_triple)
+JOIN_ADJACENTS = Rule('join_adjacents', 2, _join_adjacent)
+FIX_INVERSIONS = Rule('fix_inversions', 2, _fix_inversion)
+RENAME_ERRORS = Rule('rename_errors', 1, _rename_error)
+FIX_COMMON_ERRORS = Rule('fix_common_errors', 2, _fix_common_error)
+FIX_VS = Rule('fix_Vs', 1, _fix_V)
+FIX_BASSES = Rule('fix_basses', 1, _fix_bass)
+
+# the refinements in the order refine runs them
+RULES = [
+  FILL_GAPS,
+  FIX_PREFIXES,
+  FIX_TRIPLES,
+  JOIN_ADJACENTS,
+  FIX_INVERSIONS,
+  RENAME_ERRORS,
+  FIX_COMMON_ERRORS,
+  FIX_VS,
+  FIX_BASSES
+]
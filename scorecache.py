@@ -0,0 +1,85 @@
+import hashlib
+import os
+
+import picklefile
+
+"""
+Disk cache of parsed scores.  Parsing a score with music21 is the slowest
+part of an analysis, so after the first parse EfficientScore stores what it
+distilled from the score (the NoteTable of every measure, the time
+signature and the measure numbers) under a digest of the file.  Later
+analyses of the same file load that instead of parsing it again.
+
+The digest covers the file's name and contents, the music21 version, the
+passing tone window and cache_version, so a cached score is never used
+after any of them changes; bump cache_version when the stored format or
+the way scores are distilled changes
+"""
+cache_dir = 'scorecache/'
+cache_version = 2
+
+"""
+The time signature of a cached score.  Stands in for music21's
+TimeSignature, of which only numerator and denominator are used
+"""
+class TimeSignature(object):
+
+  __slots__ = ('numerator', 'denominator')
+
+  def __init__(self, numerator, denominator):
+    self.numerator = numerator
+    self.denominator = denominator
+
+  def __repr__(self):
+    return 'TimeSignature({0}/{1})'.format(self.numerator, self.denominator)
+
+"""
+Returns the installed music21 version without importing music21
+"""
+def music21_version():
+  try:
+    from importlib import metadata
+    return metadata.version('music21')
+  except Exception:
+    return 'unknown'
+
+"""
+Returns the key under which the score in filename is cached
+"""
+def score_digest(filename, passing_window):
+  h = hashlib.sha1()
+  h.update('{0}\0{1}\0{2}\0{3}\0'.format(cache_version, music21_version(),
+    passing_window, filename).encode('utf-8'))
+  f = open(filename, 'rb')
+  h.update(f.read())
+  f.close()
+  return h.hexdigest()
+
+def cache_path(digest, path=cache_dir):
+  return os.path.join(path, digest + '.pickle')
+
+"""
+Writes (time signature, measure numbers, tables) of a score to the cache
+"""
+def save(digest, time_sig, measure_nums, tables, path=cache_dir):
+  ts = None
+  if not time_sig == None:
+    ts = (time_sig.numerator, time_sig.denominator)
+  try:
+    picklefile.save(cache_path(digest, path), cache_version,
+        (digest, ts, measure_nums, tables))
+  except (IOError, OSError):
+    pass
+
+"""
+Returns (time signature, measure numbers, tables) of the score cached
+under digest, or None if it is missing or unreadable
+"""
+def load(digest, path=cache_dir):
+  contents = picklefile.load(cache_path(digest, path), cache_version)
+  if contents == None or not contents[0] == digest:
+    return None
+  cached_digest, ts, measure_nums, tables = contents
+  if not ts == None:
+    ts = TimeSignature(*ts)
+  return ts, measure_nums, tables
@@ -1,3 +1,14 @@
+import numpy
+
+# weights of the durations of passing tones and of other notes in the pitch
+# class histogram of a section
+passing_weight = 0.5
+nonpassing_weight = 3
+
+# distance between two sections whose bottoms are different pitch classes.
+# A bottom against none costs 101, more than mlabel will ever accept
+bottom_penalty = 2
+
 """
 Data type that stores information about a section of a Mozart piano sonata
 """
@@ -21,11 +32,103 @@ class Section(object):
         start = 200
         break
     return (start + dict_distance(self.fdict, other.fdict) + 
-        1 * bottom_distance(self.bottom, other.bottom))
+        bottom_distance(self.bottom, other.bottom))
 
   def __repr__(self):
     return '{0} {1} {2}'.format(self.numeral, self.fdict, self.bottom)
 
+"""
+A list of template Sections compiled into arrays, so that the distance
+from a section to every template is computed at once: a row per template
+of the scaled pitch class histogram, the bottom pitch class (-1 for none)
+and the required pitch classes as a bit mask
+"""
+class Sectionary(list):
+
+  def __init__(self, sections):
+    list.__init__(self, sections)
+    self.numerals = [sec.numeral for sec in sections]
+    self.hists = numpy.zeros((len(sections), 12))
+    self.has = numpy.zeros((len(sections), 12), dtype=bool)
+    self.bottoms = numpy.empty(len(sections), dtype=int)
+    self.required = numpy.zeros(len(sections), dtype=int)
+    for i, sec in enumerate(sections):
+      for p in sec.fdict:
+        self.hists[i, p] = sec.fdict[p]
+        self.has[i, p] = True
+      self.bottoms[i] = -1 if sec.bottom == None else sec.bottom
+      self.required[i] = pitch_class_mask(sec.rset)
+
+  """
+  Returns an array of sec.distance(other) for every template sec, with
+  penalty as the distance between different bottoms
+  """
+  def distances(self, other, penalty=bottom_penalty):
+    return (self.pitch_distances(other) +
+        self.bottom_distances(other.bottom, penalty))
+
+  """
+  Returns the part of distances that does not depend on bottoms: the
+  penalty for missing required pitch classes plus the histogram distance
+  """
+  def pitch_distances(self, other):
+    hist = numpy.zeros(12)
+    for p in other.fdict:
+      hist[p] = other.fdict[p]
+    present = pitch_class_mask(other.fdict)
+    required = self.required | pitch_class_mask(other.rset)
+    start = numpy.where(required & ~present, 200, 0)
+    return start + self._dict_distances(hist, other.fdict)
+
+  """
+  Returns an array of bottom_distance(sec.bottom, bottom, penalty) for
+  every template sec
+  """
+  def bottom_distances(self, bottom, penalty=bottom_penalty):
+    bottom = -1 if bottom == None else bottom
+    unmatched = (self.bottoms == -1) ^ (bottom == -1)
+    return numpy.where(self.bottoms == bottom, 0, 
+        numpy.where(unmatched, 101, penalty))
+
+  """
+  Returns dict_distance(sec.fdict, fdict) for every template sec.  The
+  squares are added up in the order dict_distance visits them, so the
+  results are bit for bit the same and ties stay ties
+  """
+  def _dict_distances(self, hist, fdict):
+    squares = (self.hists - hist) ** 2
+    cols = list(fdict)
+    terms = numpy.concatenate((numpy.where(self.has, squares, 0),
+        numpy.where(self.has[:, cols], 0, squares[:, cols])), axis=1)
+    # cumsum adds strictly left to right, unlike sum
+    return terms.cumsum(axis=1)[:, -1]
+
+  """
+  Returns the k templates closest to other as pairs (distance, numeral),
+  ordered by distance and then by position in the sectionary
+  """
+  def nearest(self, other, k, penalty=bottom_penalty):
+    return self.best(self.distances(other, penalty), k)
+
+  """
+  Returns the k templates with the smallest of the distances d, an array
+  as returned by distances, as pairs (distance, numeral)
+  """
+  def best(self, d, k):
+    if k < len(d):
+      kth = d[numpy.argpartition(d, k - 1)[:k]].max()
+      candidates = numpy.flatnonzero(d <= kth)
+    else:
+      candidates = numpy.arange(len(d))
+    best = candidates[numpy.argsort(d[candidates], kind='stable')][:k]
+    return [(float(d[i]), self.numerals[i]) for i in best]
+
+def pitch_class_mask(pcs):
+  mask = 0
+  for p in pcs:
+    mask |= 1 << p
+  return mask
+
 """
 Reads a Section object from a string like
 V\n25\n0 0 0 0 0 0 0 0 0 0 0 0 \n0 0 0 0 0 0 0 0 0 0 0 0
@@ -62,51 +165,49 @@ def from_string(s):
 """
 Returns a section that represents the given notes in the given key
 """
-def from_notes(notes, k):
-  fdict = rotate(dur_dict(notes), k)
+def from_notes(notes, k, passing_w=passing_weight,
+    nonpassing_w=nonpassing_weight):
+  fdict = rotate(dur_dict(notes, passing_w, nonpassing_w), k)
   bottom = get_bottom(notes, k)
   rset = set()
 
   return Section(None, fdict, bottom, rset)
 
 """
-Returns the pitch class of the note with lowest pitch, or None if 
-that note is within a third of the next lowest note
+Returns the pitch class of the note with lowest pitch in the NoteTable,
+or None if that note is within a third of the next lowest note
 """
 def get_bottom(notes, k):
-  s_notes = sorted([(n.pitch.midi, n) for n in notes])
+  s_notes = sorted(zip(notes.midi, notes.offset))
   if len(notes) < 1:
     return None
-  lowest_midi = s_notes[0][0]
+  lowest_midi, lowest_offset = s_notes[0]
   
   if len(notes) == 1:
     return None
 
-  for p, n in s_notes:
+  for p, offset in s_notes:
     if not p == lowest_midi:
-      if p - lowest_midi > 2 or n.offset == s_notes[0][1].offset:
+      if p - lowest_midi > 2 or offset == lowest_offset:
         return (lowest_midi - k) % 12
       else:
         return None
   return None
 
 """
-Returns a dictionary of total pitch class duration for the given pitch 
-list
+Returns a dictionary of total pitch class duration for the given NoteTable,
+weighting the durations of passing tones by passing_w and of other notes
+by nonpassing_w
 """
-def dur_dict(notes):
-  passing_weight = 0.5
-  nonpassing_weight = 3
+def dur_dict(notes, passing_w=passing_weight, nonpassing_w=nonpassing_weight):
   result = dict()
-  for n in notes:
-    p = n.pitch.pitchClass
-    d = n.duration.quarterLength
+  for p, d, passing in zip(notes.pitch_class, notes.duration, notes.passing):
     if not p in result:
       result[p] = 0
-    if n.isPassing:
-      result[p] += passing_weight * d
+    if passing:
+      result[p] += passing_w * d
     else:
-      result[p] += nonpassing_weight * d
+      result[p] += nonpassing_w * d
   return result
 
 """""
@@ -146,11 +247,11 @@ def dict_distance(d1, d2):
       result += x2 * x2
   return result
 
-def bottom_distance(bot1, bot2):
+def bottom_distance(bot1, bot2, penalty=bottom_penalty):
   if bot1 == None and not bot2 == None:
     return 101
   if bot2 == None and not bot1 == None:
     return 101
   if bot1 == bot2:
     return 0
-  return 2
+  return penalty
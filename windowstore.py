@@ -0,0 +1,137 @@
+from collections import OrderedDict
+
+import numpy
+
+import mprofile
+import section
+
+"""
+What is known about one window of a score, a span of a measure heard in
+a key: its notes and, computed the first time they are asked for, the
+section (rotated pitch class histogram and bottom) the templates are
+compared with, the bass and pitch classes the refinements look at, and
+the distance to every template
+"""
+class Window(object):
+
+  __slots__ = ('measure', 'start', 'stop', 'key', 'major', 'notes',
+      'sectionary', '_section', '_summary', '_distances', '_ranked')
+
+  def __init__(self, measure, start, stop, key, major, notes, sectionary):
+    self.measure = measure
+    self.start = start
+    self.stop = stop
+    self.key = key
+    self.major = major
+    self.notes = notes
+    self.sectionary = sectionary
+    self._section = None
+    self._summary = None
+    self._distances = None
+    self._ranked = None
+
+  """
+  Returns the section.Section of the notes in the window's key
+  """
+  def section(self):
+    if self._section == None:
+      self._section = section.from_notes(self.notes, self.key)
+    return self._section
+
+  """
+  Returns the scaled pitch class histogram of the notes, rotated into the
+  window's key
+  """
+  def histogram(self):
+    return self.section().fdict
+
+  def bottom(self):
+    return self.section().bottom
+
+  """
+  Returns (bass MIDI number, bass pitch class, set of pitch classes, pitch
+  class mask) of the notes
+  """
+  def summary(self):
+    if self._summary == None:
+      notes = self.notes
+      pcs = notes.pitch_class_set()
+      self._summary = (notes.bass_midi(), notes.bass_pitch_class(), pcs,
+          section.pitch_class_mask(pcs))
+    return self._summary
+
+  """
+  Returns the array of distances from the window to every template
+  """
+  def distances(self):
+    if self._distances is None:
+      self._distances = self.sectionary.distances(self.section())
+    return self._distances
+
+  """
+  Returns the indices of every template in the sectionary, nearest first
+  and in sectionary order among equals
+  """
+  def ranked(self):
+    if self._ranked is None:
+      self._ranked = numpy.argsort(self.distances(), kind='stable')
+    return self._ranked
+
+  """
+  Returns the k nearest templates as pairs (distance, numeral), as
+  section.Sectionary.nearest does
+  """
+  def nearest(self, k):
+    d = self.distances()
+    if self._ranked is None:
+      return self.sectionary.best(d, k)
+    numerals = self.sectionary.numerals
+    return [(float(d[i]), numerals[i]) for i in self._ranked[:k]]
+
+"""
+The windows of a score, keyed by (measure, start_int, stop_int, key,
+major), so that the templates in mlabel and the refinements share the
+notes and features of each window instead of computing them again.  The
+major-key templates are sectionaries[0] and the minor ones
+sectionaries[1]; sectionaries may be None when no distances are needed.
+A store with a size keeps only that many windows, evicting the least
+recently used, which bounds it when a piece is analyzed as a stream
+"""
+class WindowStore(object):
+
+  def __init__(self, es, sectionaries=None, size=None):
+    self.es = es
+    self.sectionaries = sectionaries
+    self.size = size
+    self.windows = OrderedDict()
+
+  """
+  Returns the Window of [start, stop) of measure m (start and stop in
+  quarter notes) in the key with tonic pitch class k
+  """
+  def window(self, m, start, stop, k, major):
+    key = (m, int(round(2 * start)), int(round(2 * stop)), k, major)
+    w = self.windows.get(key)
+    if not w == None:
+      mprofile.count('window store hits')
+      if not self.size == None:
+        self.windows.move_to_end(key)
+      return w
+    sectionary = None
+    if not self.sectionaries == None:
+      sectionary = self.sectionaries[0] if major else self.sectionaries[1]
+    w = Window(m, start, stop, k, major,
+        self.es.notes_in_measure(m, start, stop), sectionary)
+    self.windows[key] = w
+    if not self.size == None and len(self.windows) > self.size:
+      self.windows.popitem(last=False)
+    return w
+
+  """
+  Returns the Window under the span of the label.Label lab
+  """
+  def label_window(self, lab):
+    return self.window(lab.measure, lab.start, lab.stop, lab.key, lab.major)
+
+  def __len__(self):
+    return len(self.windows)